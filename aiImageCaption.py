@@ -1,32 +1,353 @@
-from langchain_ollama import ChatOllama
-from langchain_core.messages import HumanMessage 
-from langsmith import traceable
+# langchain, langsmith, pydantic, httpx, PIL and pillow_heif are imported where they are first
+# used, so --help and runs without still images start without loading them
 from dotenv import load_dotenv
-from PIL import Image
-from pillow_heif import register_heif_opener
-from pydantic import BaseModel
 import os
 import base64
+import hashlib
+import json
+import csv
+import sqlite3
+import io
 import shutil
 import argparse
+import sys
 import re
 import time
-
-start_time=time.time()
+import tempfile
+import urllib.parse
+import threading
+import queue
+import asyncio
+import random
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 
 DEBUG_MODE=False
 def debug_print(*args, **kwargs):
     if DEBUG_MODE:
         print(*args, **kwargs)
 
-register_heif_opener()
+heif_opener_registered=False
+def pil_image():
+    # PIL's Image module with the heif opener registered, imported on first use
+    global heif_opener_registered
+    from PIL import Image
+    if not heif_opener_registered:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+        heif_opener_registered=True
+    return Image
+
+# Limit on concurrent HEIC decodes, replaced from the command line
+decode_slots = threading.BoundedSemaphore(1)
+
+# Settings for the image sent to the LLM, replaced from the command line.
+# A max edge of 0 sends the original file unchanged, heic files are still transcoded
+LLM_IMAGE_MAX_EDGE=1024
+LLM_IMAGE_FORMAT="jpeg"
+LLM_IMAGE_QUALITY=85
+# Formats every vision model decodes, sent as is when already within LLM_IMAGE_MAX_EDGE
+# as re-encoding a small image only makes it bigger
+LLM_ORIGINAL_FORMATS={"JPEG", "PNG", "WEBP"}
+
+# Prompt sent with every image, also part of the caption cache key
+KEYWORD_PROMPT="Get a list of the top 4 keywords that describe the image. "
+
+# How files are copied to the destination, replaced from the command line. "auto" uses reflinks
+# (copy on write clones) when source and destination share a file system that supports them
+TRANSFER_MODE="auto"
+FICLONE=0x40049409
+COPY_BUFFER_SIZE=8 * 1024 * 1024
+reflink_unsupported=set()
+# Permissions of new files, the umask can only be read by setting it so this is done once at start up
+UMASK=os.umask(0)
+os.umask(UMASK)
+
+# Name of the incremental run manifest kept in the destination folder
+MANIFEST_FILE_NAME=".aiImageCaption_manifest.sqlite"
+# Name of the keyword search index written into the destination folder
+KEYWORD_INDEX_FILE_NAME=".aiImageCaption_keywords.sqlite"
+
+# The engine sending LLM requests to the Ollama hosts, created from caption_engine_settings on the
+# first request, and the optional request batcher
+caption_engine=None
+caption_engine_settings=None
+caption_engine_lock=threading.Lock()
+caption_batcher=None
+
+# Persistent caption cache, created from the command line unless --no-cache is used
+caption_cache=None
+# Perceptual hashes of images captioned this run, set up with --dedupe
+near_duplicates=None
+# Images whose 9x8 grey thumbnail spans fewer levels than this, or whose hash has fewer bits of
+# one value than LOW_DETAIL_BITS, are too plain to compare and are always sent to the LLM
+LOW_DETAIL_SPREAD=16
+LOW_DETAIL_BITS=4
+# Limit on the estimated memory of images being decoded at the same time, set up with --max-memory
+memory_budget=None
+
+class FormatHandler:
+    """
+    How source files of one type are written to the destination.
+
+    Args:
+        action (str): "convert" decodes the file and re-encodes it with the HEIC_OUTPUT encoder,
+            "copy" transfers it as is and "live_photo" copies it unless it is the video of a heic photo.
+        caption (bool): The file is an image captioned by the LLM and named from its keywords.
+        mime_type (str): MIME type of the original file, used when it is sent to the LLM as is.
+    """
+    def __init__(self, action, caption=False, mime_type=None):
+        self.action = action
+        self.caption = caption
+        self.mime_type = mime_type
+
+# Handlers keyed by lower case extension, so each file is dispatched with a single dict lookup.
+# Files with extensions not registered here are skipped
+FORMAT_HANDLERS={}
+def register_format(extensions, action, caption=False, mime_type=None):
+    handler = FormatHandler(action, caption, mime_type)
+    for extension in extensions:
+        FORMAT_HANDLERS[extension] = handler
+
+register_format([".heic", ".heif"], "convert", caption=True, mime_type="image/heic")
+register_format([".jpg", ".jpeg"], "copy", caption=True, mime_type="image/jpeg")
+register_format([".png"], "copy", caption=True, mime_type="image/png")
+register_format([".gif"], "copy", caption=True, mime_type="image/gif")
+register_format([".bmp"], "copy", caption=True, mime_type="image/bmp")
+register_format([".tif", ".tiff"], "copy", caption=True, mime_type="image/tiff")
+register_format([".webp"], "copy", caption=True, mime_type="image/webp")
+register_format([".mp4"], "copy")
+register_format([".mov"], "live_photo")
+
+# Output format of converted heic files, replaced from the command line. "keep" copies them as is
+HEIC_OUTPUT="jpeg"
+# Encoders for converted files, the save settings are passed to PIL and replaced from the command line.
+# PNG optimize and high compress levels cost seconds per 12MP photo for a few percent smaller files
+OUTPUT_ENCODERS={
+    "jpeg": {"extension": ".jpg", "mime_type": "image/jpeg", "save": {"quality": 75}},
+    "png": {"extension": ".png", "mime_type": "image/png", "save": {"compress_level": 1, "optimize": False}},
+    "webp": {"extension": ".webp", "mime_type": "image/webp", "save": {"quality": 80, "method": 4}},
+}
+
+keyword_schemas={}
+def get_keyword_schemas():
+    # The pydantic datatypes for the LLM output, keyed "single" and "batch", defined on first use
+    if not keyword_schemas:
+        from pydantic import BaseModel
+
+        # Define a datatype to be used to formate the LLM output
+        class File_Keywords(BaseModel):
+                keywords: list[str]  # A list of strings
 
-# Define a datatype to be used to formate the LLM output
-class File_Keywords(BaseModel):
-        keywords: list[str]  # A list of strings
+        # Datatypes for batched requests, keywords for each image identified by its position in the request
+        class Image_Keywords(BaseModel):
+                index: int
+                keywords: list[str]
+
+        class Batch_Keywords(BaseModel):
+                images: list[Image_Keywords]
+
+        keyword_schemas.update({"single": File_Keywords, "batch": Batch_Keywords})
+    return keyword_schemas
 
 load_dotenv(dotenv_path=".env", override=True)
 
+def traceable(func):
+    # langsmith tracing of func, only loaded when tracing is turned on in the environment or .env
+    if os.environ.get("LANGSMITH_TRACING", os.environ.get("LANGCHAIN_TRACING_V2", "")).lower() != "true":
+        return func
+    from langsmith import traceable as langsmith_traceable
+    return langsmith_traceable(func)
+
+class RunStats:
+    """
+    Collects how long each stage (scan, hash, heic_decode, preprocess, llm, copy ...)
+    takes for every file, for the summary printed at the end of a run and the optional
+    json/csv report. Stage times are attributed to the file the current thread is working on.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # Set by watch mode so its batches add up to one running total
+        self.accumulate = False
+        self.start()
+
+    def start(self):
+        self.end_time = None
+        if self.accumulate:
+            return
+        self.start_time = time.time()
+        self.stages = {}
+        self.files = []
+
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def begin_file(self, source_path):
+        try:
+            file_size = os.path.getsize(source_path)
+        except OSError:
+            file_size = None
+        self.local.record = {"file": source_path, "bytes": file_size, "status": None, "stages": {}}
+        self.local.file_start = time.perf_counter()
+
+    def end_file(self, status):
+        record = getattr(self.local, "record", None)
+        if record is None:
+            return
+        record["status"] = status
+        self.record("total", time.perf_counter() - self.local.file_start)
+        self.local.record = None
+        with self.lock:
+            self.files.append(record)
+
+    @contextmanager
+    def timed(self, stage):
+        stage_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - stage_start)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.stages.setdefault(stage, []).append(seconds)
+        record = getattr(self.local, "record", None)
+        if record is not None:
+            record["stages"][stage] = record["stages"].get(stage, 0) + seconds
+
+    @staticmethod
+    def percentile(sorted_values, fraction):
+        return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+    def summary(self):
+        elapsed = self.elapsed()
+        stages = {}
+        with self.lock:
+            for stage, values in self.stages.items():
+                sorted_values = sorted(values)
+                stages[stage] = {"count": len(values), "total": sum(values),
+                                 "p50": self.percentile(sorted_values, 0.5),
+                                 "p95": self.percentile(sorted_values, 0.95),
+                                 "max": sorted_values[-1]}
+            files = len(self.files)
+        return {"files": files, "elapsed": elapsed, "files_per_second": files / elapsed if elapsed else 0,
+                "peak_rss_mb": peak_rss_mb(), "stages": stages}
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"\n{summary['files']} files in {round(summary['elapsed'],1)}s, "
+              f"{round(summary['files_per_second'],2)} files/s, peak RSS {summary['peak_rss_mb']}MB")
+        print(f"{'stage':<12}{'count':>8}{'total s':>10}{'p50 s':>9}{'p95 s':>9}{'max s':>9}")
+        order = ["scan", "hash", "cache", "heic_decode", "preprocess", "dedupe", "llm", "copy", "total"]
+        for stage, values in sorted(summary["stages"].items(),
+                                    key=lambda item: order.index(item[0]) if item[0] in order else len(order)):
+            print(f"{stage:<12}{values['count']:>8}{values['total']:>10.2f}{values['p50']:>9.3f}"
+                  f"{values['p95']:>9.3f}{values['max']:>9.3f}")
+
+    def write_report(self, report_path):
+        # A .csv path gets one row per file with the seconds spent in each stage, anything else
+        # gets json with the summary and the per file records
+        with self.lock:
+            files = list(self.files)
+        if report_path.lower().endswith(".csv"):
+            stages = sorted({stage for record in files for stage in record["stages"]})
+            with open(report_path, "w", newline="") as report_file:
+                writer = csv.writer(report_file)
+                writer.writerow(["file", "bytes", "status"] + stages)
+                for record in files:
+                    writer.writerow([record["file"], record["bytes"], record["status"]] +
+                                    [round(record["stages"].get(stage, 0), 4) for stage in stages])
+        else:
+            with open(report_path, "w") as report_file:
+                json.dump({"summary": self.summary(), "files": files}, report_file, indent=1)
+        print(f"Run report written to '{report_path}'")
+
+run_stats = RunStats()
+
+def peak_rss_mb():
+    # Peak resident set size of this process, not available on Windows
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1048576 if sys.platform == "darwin" else 1024), 1)
+
+class MemoryBudget:
+    """
+    Admits image decodes while the sum of their estimated memory stays under a limit, so
+    parallel workers on huge panoramas or TIFFs wait for each other instead of exhausting RAM.
+    An image is always admitted when nothing else is in flight, even if it is over the limit alone.
+
+    Args:
+        limit (int): Bytes of estimated decode memory allowed at the same time.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, amount):
+        with self.condition:
+            if self.in_use and self.in_use + amount > self.limit:
+                self.waits += 1
+                self.condition.wait_for(lambda: not self.in_use or self.in_use + amount <= self.limit)
+            self.in_use += amount
+            self.peak = max(self.peak, self.in_use)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_use -= amount
+                self.condition.notify_all()
+
+def estimate_decode_memory(image_path, draft_size=0, output_copy=False):
+    """
+    Estimates the bytes needed to decode an image from its header, PIL only reads the
+    pixels when they are used so no decode happens here.
+
+    Args:
+        image_path (str): The path to the image file.
+        draft_size (int): Edge the jpeg decoder is asked to scale down to, 0 for a full decode.
+        output_copy (bool): An encoded copy of the full image is kept in memory as well.
+
+    Returns:
+        int: The estimated bytes.
+    """
+    try:
+        with pil_image().open(image_path) as img:
+            if draft_size > 0:
+                img.draft("RGB", (draft_size, draft_size))
+            width, height = img.size
+            mode = img.mode
+            bands = len(img.getbands())
+    except Exception:
+        # Unreadable header, the decode will fail soon enough, guess from the file size
+        return os.path.getsize(image_path) * 10
+    pixels = width * height
+    # 16 bit and float modes use more than a byte per band
+    estimate = pixels * bands * (4 if mode in ("I", "F") or mode.startswith("I;16") else 1)
+    if mode != "RGB":
+        # Converted to an RGB copy
+        estimate += pixels * 3
+    if output_copy:
+        estimate += pixels
+    return estimate
+
+@contextmanager
+def memory_reserved(image_path, draft_size=0, output_copy=False):
+    # Waits for room in memory_budget for decoding image_path, does nothing without a budget
+    if memory_budget is None:
+        yield
+        return
+    with memory_budget.reserve(estimate_decode_memory(image_path, draft_size, output_copy)):
+        yield
+
 def dir_path(file_path):
     """
     Validates a file path using a regular expression.
@@ -47,29 +368,146 @@ parser = argparse.ArgumentParser(
                     prog='aiImageCaption',
                     description="Create a copy of image files based on scanning a directory. " +
                     "The files will be given new more descriptive names based on AI analysis " +
-                    "of the images. heic files will be converted to jpg files")
+                    "of the images. heic files will be converted to jpg files (see --heic-output)",
+                    epilog="Run aiImageCaption.py --search <destination> <keyword> ... to find captioned files by keyword")
 parser.add_argument("source",type=dir_path, help="Source directory containing images and subdirectories to be captioned")
 parser.add_argument("destination", type=dir_path, help="Destination directory , where updated files are placed")
 parser.add_argument('-m', '--model', nargs='?',  default="granite3.2-vision:2b", type=str,
                     help='Optional Ollama hosted vision model. Defaults to granite3.2-vision:2b if not specified')
-parser.add_argument('-u', '--url', nargs='?',  default="http://192.168.1.117:11434", type=str,
-                    help='Optional base URL for Ollama. Defaults to http://192.168.1.117:11434 if not specified')
+parser.add_argument('-u', '--url', action='append', default=None, type=str,
+                    help='Optional base URL for Ollama, several hosts (repeat -u or comma separate them) share the requests. ' +
+                    'Defaults to http://192.168.1.117:11434 if not specified')
+parser.add_argument('--health-interval', default=15, type=float,
+                    help='Seconds between health checks of the Ollama hosts. Defaults to 15')
+parser.add_argument('--max-edge', default=1024, type=int,
+                    help='Longest edge in pixels of the image sent to the LLM. 0 sends the original file. Defaults to 1024')
+parser.add_argument('--llm-image-format', default="jpeg", choices=["jpeg", "webp"],
+                    help='Format of the downsized image sent to the LLM. Defaults to jpeg')
+parser.add_argument('--llm-image-quality', default=85, type=int,
+                    help='Encoder quality of the downsized image sent to the LLM. Defaults to 85')
+parser.add_argument('--cache', default="aiImageCaption_cache.sqlite", type=str,
+                    help='SQLite file used to cache keywords between runs. Defaults to aiImageCaption_cache.sqlite')
+parser.add_argument('--no-cache', action='store_true',
+                    help='Do not read or write the keyword cache')
+parser.add_argument('--refresh-cache', action='store_true',
+                    help='Ignore cached keywords and store fresh LLM results')
+parser.add_argument('--cache-max-entries', default=200000, type=int,
+                    help='Cache entries kept, least recently used are evicted first. 0 for no limit. Defaults to 200000')
+parser.add_argument('--cache-max-age', default=365, type=float,
+                    help='Days before a cache entry is evicted. 0 for no limit. Defaults to 365')
+parser.add_argument('--llm-timeout', default=120, type=float,
+                    help='Seconds before an LLM request is abandoned and retried. Defaults to 120')
+parser.add_argument('--llm-retries', default=3, type=int,
+                    help='Retries for LLM requests failing with timeouts, connection or server errors. Defaults to 3')
+parser.add_argument('--retry-backoff', default=2, type=float,
+                    help='Seconds before the first retry, doubled for each further retry. Defaults to 2')
+parser.add_argument('--breaker-threshold', default=5, type=int,
+                    help='Consecutive LLM failures that pause all requests. Defaults to 5')
+parser.add_argument('--breaker-cooldown', default=30, type=float,
+                    help='Seconds requests are paused for when the LLM server is failing or overloaded. Defaults to 30')
+parser.add_argument('--batch-size', default=1, type=int,
+                    help='Images sent to the LLM in one request when several workers and LLM workers are captioning. Defaults to 1 (no batching)')
+parser.add_argument('--batch-wait', default=0.5, type=float,
+                    help='Seconds to wait for a batch to fill before sending it. Defaults to 0.5')
+parser.add_argument('--report', default=None, type=str,
+                    help='Write per stage timings to this file, csv (one row per file) if it ends in .csv, otherwise json')
+parser.add_argument('--profile', default=None, type=str,
+                    help='Run under cProfile and write the stats to this file (covers the main thread, use with -w 1)')
+parser.add_argument('--tracemalloc', action='store_true',
+                    help='Trace memory allocations and print the peak and top allocation sites at the end')
+parser.add_argument('-i', '--incremental', action='store_true',
+                    help='Resume into an existing destination, skipping files already done and retrying failed ones')
+parser.add_argument('--heic-output', default="jpeg", choices=["jpeg", "png", "webp", "keep"],
+                    help='Format heic files are converted to, keep copies them unconverted. Defaults to jpeg')
+parser.add_argument('--jpeg-quality', default=75, type=int, help='Quality of converted jpg files (1-95). Defaults to 75')
+parser.add_argument('--webp-quality', default=80, type=int, help='Quality of converted webp files (1-100). Defaults to 80')
+parser.add_argument('--png-compress-level', default=1, type=int,
+                    help='zlib level of converted png files, 0 (fastest, largest) to 9 (slowest, smallest). Defaults to 1')
+parser.add_argument('--png-optimize', action='store_true',
+                    help='Search for the smallest png encoding, several times slower. Defaults to off')
+parser.add_argument('--max-memory', default=0, type=int,
+                    help='MB of estimated image decode memory allowed across workers, estimated from image headers. ' +
+                    'Workers wait for room before decoding. Defaults to 0 (no limit)')
+parser.add_argument('--dedupe', action='store_true',
+                    help='Reuse the keywords of an image captioned earlier in the run for near duplicates ' +
+                    '(burst shots, re-saved copies), found by comparing perceptual hashes, instead of calling the LLM')
+parser.add_argument('--dedupe-threshold', default=6, type=int,
+                    help='Most bits (of 64) two perceptual hashes may differ by to count as near duplicates. Defaults to 6')
+parser.add_argument('--transfer', default="auto", choices=["auto", "copy", "reflink", "hardlink"],
+                    help='How files are written to the destination. auto uses reflinks where the file system supports ' +
+                    'them and copies otherwise, hardlink shares the file with the source. Defaults to auto')
+parser.add_argument('--no-index', action='store_true',
+                    help='Do not write the keyword search index (' + KEYWORD_INDEX_FILE_NAME + ') into the destination folder')
+parser.add_argument('--plan', action='store_true',
+                    help='Only scan the source, classify every file, estimate the run time and list destination conflicts, ' +
+                    'without writing anything')
+parser.add_argument('--plan-out', default=None, type=str, help='Write the plan (implies --plan) to a json file for --execute-plan')
+parser.add_argument('--plan-stats', default=None, type=str,
+                    help='A --report json file of an earlier run, its stage times are used for the --plan estimate. ' +
+                    'Defaults to rough built in figures')
+parser.add_argument('--execute-plan', default=None, type=str,
+                    help='Process exactly the files of a plan written with --plan-out, with the same source and destination')
+parser.add_argument('--watch', action='store_true',
+                    help='Keep running and caption files as they arrive in the source, after bringing the destination ' +
+                    'up to date like --incremental. Stop with Ctrl+C')
+parser.add_argument('--watch-settle', default=2.0, type=float,
+                    help='Seconds a new file must stay the same size before it is processed. Defaults to 2')
+parser.add_argument('--watch-poll', default=0, type=float,
+                    help='Seconds between scans of the source instead of inotify. Defaults to 0 (inotify on Linux, ' +
+                    'scans every 5 seconds elsewhere)')
+parser.add_argument('--watch-stats', default=60, type=float,
+                    help='Seconds between printed queue depth and latency counters in watch mode. Defaults to 60')
+parser.add_argument('--keep-alive', default=None, type=str,
+                    help='How long Ollama keeps the model loaded after a request, for example 30m or -1 for always. ' +
+                    'Defaults to the Ollama setting, or 30m with --watch')
+parser.add_argument('-w', '--workers', default=1, type=int,
+                    help='Number of files processed at the same time. Defaults to 1 (one file at a time)')
+parser.add_argument('--decode-workers', default=None, type=int,
+                    help='Maximum concurrent HEIC decodes. Defaults to the number of workers')
+parser.add_argument('--llm-workers', default=None, type=int,
+                    help='Maximum concurrent LLM requests. Defaults to the number of workers')
 
 
-def convert_heic_to_jpeg(heic_path, jpeg_path):
+def convert_image(image_path, output_format):
+    """
+    Decodes an image (a heic file) once and encodes it in output_format in memory, also returning
+    the image prepared for the LLM from the same decoded pixels, so no scratch file is written and
+    the converted file can be written straight to its final keyword based name.
+
+    Args:
+        image_path (str): The path to the image file.
+        output_format (str): A key of OUTPUT_ENCODERS.
+
+    Returns:
+        tuple[bytes, tuple[bytes, str]]: The converted file content and the image for the LLM with
+        its MIME type, None if the conversion failed.
+    """
+    encoder = OUTPUT_ENCODERS[output_format]
     try:
-        with Image.open(heic_path) as img:
-            # Extract EXIF data (if present)
-            exif_data = img.info.get('exif')
-            # Convert to RGB mode if not already (important for saving as JPG)
-            rgb_image = img.convert("RGB")
-            # Save the image as JPG, including the extracted EXIF data
-            if exif_data:
-                rgb_image.save(jpeg_path, format="jpeg", exif=exif_data)
-            else:
-                rgb_image.save(jpeg_path, format="jpeg")
+        with pil_image().open(image_path) as img:
+            with run_stats.timed("heic_decode"):
+                # Extract EXIF data (if present)
+                exif_data = img.info.get('exif')
+                # Convert to RGB mode if not already (important for saving as JPG), heic files
+                # usually decode as RGB so this avoids a second full size copy of the pixels
+                rgb_image = img if img.mode == "RGB" else img.convert("RGB")
+                # Encode the image, including the extracted EXIF data
+                buffer = io.BytesIO()
+                if exif_data:
+                    rgb_image.save(buffer, format=output_format, exif=exif_data, **encoder["save"])
+                else:
+                    rgb_image.save(buffer, format=output_format, **encoder["save"])
+            converted_bytes = buffer.getvalue()
+            del buffer
+            if LLM_IMAGE_MAX_EDGE <= 0:
+                # Preprocessing disabled, the LLM gets the full converted file
+                return converted_bytes, (converted_bytes, encoder["mime_type"])
+            # Downsized while the image is still open, closing it frees the pixels
+            with run_stats.timed("preprocess"):
+                return converted_bytes, encode_for_llm(rgb_image, image_path, os.path.getsize(image_path), time.time())
     except Exception as e:
-        print(f"Error converting '{heic_path}': {e}")
+        print(f"Error converting '{image_path}': {e}")
+        return None
 
 def keywords_to_filename(file_path:str,keywords:list[str]):
     # Create a new file name based on image keywords and the original file name
@@ -87,138 +525,1769 @@ def keywords_to_filename(file_path:str,keywords:list[str]):
     debug_print(new_file_name)
     return os.path.join(dirname, new_file_name)
 
-def process_files(source_folder, destination_folder):
+def file_hash(file_path):
+    # sha256 of the file content, read in chunks so large files are not held in memory
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class CaptionCache:
+    """
+    Persistent SQLite store of image keywords keyed by a hash of the image content,
+    the model name and the prompt, so re-runs only call the LLM for new images.
+
+    Args:
+        cache_path (str): The path to the SQLite file.
+        max_entries (int): Entries kept after eviction, least recently used go first. 0 for no limit.
+        max_age_days (float): Entries older than this are evicted. 0 for no limit.
+        refresh (bool): Ignore stored entries, new results still replace them.
+        read_only (bool): Only look entries up (for --plan), the file must exist and nothing is evicted.
+    """
+    def __init__(self, cache_path, max_entries=0, max_age_days=0, refresh=False, read_only=False):
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.refresh = refresh
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if read_only:
+            self.connection = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(cache_path))}?mode=ro",
+                                              uri=True, check_same_thread=False)
+            return
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS captions (
+            key TEXT PRIMARY KEY,
+            keywords TEXT NOT NULL,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL)""")
+        self.connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(content_hash, model, prompt):
+        return hashlib.sha256(f"{content_hash}\n{model}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        # Returns the cached keyword list or None
+        with self.lock:
+            if self.refresh:
+                self.misses += 1
+                return None
+            row = self.connection.execute("SELECT keywords FROM captions WHERE key=?", (key,)).fetchone()
+            # Empty results stored by older versions are misses, so those images are captioned again
+            if row is None or not any(json.loads(row[0])):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE captions SET last_used=? WHERE key=?", (time.time(), key))
+            self.connection.commit()
+        return json.loads(row[0])
+
+    def contains(self, key):
+        # Whether key is cached, without counting it as a hit or marking it used
+        if self.refresh:
+            return False
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM captions WHERE key=?", (key,)).fetchone() is not None
+
+    def put(self, key, keywords):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO captions (key, keywords, created, last_used) VALUES (?, ?, ?, ?)",
+                                    (key, json.dumps(keywords), now, now))
+            self.connection.commit()
+
+    def evict(self):
+        # Remove entries past the age limit, then the least recently used ones over the size limit
+        with self.lock:
+            if self.max_age_days > 0:
+                self.connection.execute("DELETE FROM captions WHERE created < ?",
+                                        (time.time() - self.max_age_days * 86400,))
+            if self.max_entries > 0:
+                self.connection.execute("""DELETE FROM captions WHERE key IN (
+                    SELECT key FROM captions ORDER BY last_used DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+            self.connection.commit()
+
+    def close(self):
+        if not self.read_only:
+            self.evict()
+        self.connection.close()
+
+class NearDuplicateIndex:
+    """
+    BK-tree of 64 bit perceptual hashes of the images captioned in this run, so burst shots and
+    near identical frames can reuse the keywords of an earlier image instead of calling the LLM.
+    Lookups only visit subtrees that can hold a hash within the threshold (triangle inequality
+    of the Hamming distance), so they stay fast with many thousands of images. Images still
+    being captioned are kept apart, so burst shots in flight on other workers are waited for
+    instead of all being sent to the LLM.
+
+    Args:
+        threshold (int): Largest Hamming distance (of 64 bits) counted as a near duplicate.
+    """
+    def __init__(self, threshold):
+        self.threshold = threshold
+        # Nodes are [hash, keywords, source path, {distance: child node}]
+        self.root = None
+        self.size = 0
+        self.saved = 0
+        # Hashes of images being captioned -> event set when their keywords are in (or they failed)
+        self.in_flight = {}
+        # Reentrant as claim and release call find and add with the lock held
+        self.lock = threading.RLock()
+
+    def add(self, image_hash, keywords, image_path):
+        with self.lock:
+            self.size += 1
+            if self.root is None:
+                self.root = [image_hash, keywords, image_path, {}]
+                return
+            node = self.root
+            while True:
+                distance = (node[0] ^ image_hash).bit_count()
+                if distance == 0:
+                    # Same hash already indexed, keep the first keywords
+                    self.size -= 1
+                    return
+                child = node[3].get(distance)
+                if child is None:
+                    node[3][distance] = [image_hash, keywords, image_path, {}]
+                    return
+                node = child
+
+    def find(self, image_hash):
+        # Returns (distance, keywords, source path) of the closest indexed image within the threshold, or None
+        best = None
+        with self.lock:
+            nodes = [self.root] if self.root is not None else []
+            while nodes:
+                node = nodes.pop()
+                distance = (node[0] ^ image_hash).bit_count()
+                if distance <= self.threshold and (best is None or distance < best[0]):
+                    best = (distance, node[1], node[2])
+                for child_distance, child in node[3].items():
+                    if abs(child_distance - distance) <= self.threshold:
+                        nodes.append(child)
+        return best
+
+    def claim(self, image_hash):
+        """
+        Finds a near duplicate of image_hash, waiting for near duplicates still being captioned.
+        When there is none the caller is registered as captioning image_hash and must call
+        release with the result.
+
+        Returns:
+            tuple[int, list[str], str]: (distance, keywords, source path) of the near duplicate,
+            None when the caller should caption the image itself.
+        """
+        while True:
+            with self.lock:
+                match = self.find(image_hash)
+                if match is not None:
+                    return match
+                waiting_on = None
+                for in_flight_hash, event in self.in_flight.items():
+                    if (in_flight_hash ^ image_hash).bit_count() <= self.threshold:
+                        waiting_on = event
+                        break
+                if waiting_on is None:
+                    self.in_flight[image_hash] = threading.Event()
+                    return None
+            # Captioned by then (and in the tree) or failed (and gone), look again
+            waiting_on.wait()
+
+    def release(self, image_hash, keywords, image_path):
+        # Ends a claim, indexing the keywords when captioning worked
+        with self.lock:
+            if keywords:
+                self.add(image_hash, keywords, image_path)
+            event = self.in_flight.pop(image_hash)
+        event.set()
+
+class RunManifest:
+    """
+    SQLite record of every source file processed into a destination folder, used by
+    incremental runs to skip unchanged files and retry failed ones. Files are matched
+    by relative path, size and modification time, the content hash is kept for still
+    images (videos are not hashed to avoid reading them twice).
+
+    Args:
+        manifest_path (str): The path to the SQLite file.
+    """
+    def __init__(self, manifest_path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(manifest_path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+            source TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            hash TEXT,
+            destination TEXT,
+            keywords TEXT,
+            status TEXT NOT NULL,
+            updated REAL NOT NULL)""")
+        self.connection.commit()
+
+    def lookup(self, source):
+        # Returns a dict of the recorded values for a relative source path or None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, mtime, hash, destination, keywords, status FROM files WHERE source=?", (source,)).fetchone()
+        if row is None:
+            return None
+        return {"size": row[0], "mtime": row[1], "hash": row[2], "destination": row[3],
+                "keywords": json.loads(row[4]) if row[4] else [], "status": row[5]}
+
+    def record(self, source, size, mtime, content_hash, destination, keywords, status):
+        with self.lock:
+            self.connection.execute("""INSERT OR REPLACE INTO files
+                (source, size, mtime, hash, destination, keywords, status, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (source, size, mtime, content_hash, destination, json.dumps(keywords), status, time.time()))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+def is_unchanged(entry, file_stat, destination_folder):
+    # Whether a file's manifest entry says it was done (or skipped) at its current size and mtime and its
+    # output still exists, incremental runs and plans leave those files out
+    return entry is not None and entry["status"] in ("done", "skipped") and entry["size"] == file_stat.st_size \
+        and entry["mtime"] == file_stat.st_mtime \
+        and (entry["destination"] is None or os.path.exists(os.path.join(destination_folder, entry["destination"])))
+
+class KeywordIndex:
+    """
+    SQLite inverted index from keywords to the captioned files in a destination folder, so
+    photos can be found by keyword without scanning and parsing file names. Hyphenated keywords
+    are also indexed by their parts, so "beach" finds "sandy-beach". Files are keyed by their
+    path relative to the destination folder, with the absolute path of their source.
+
+    Args:
+        index_path (str): The path to the SQLite file.
+    """
+    def __init__(self, index_path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(index_path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            source TEXT,
+            hash TEXT,
+            model TEXT,
+            keywords TEXT NOT NULL,
+            updated REAL NOT NULL)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS keywords (
+            keyword TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (keyword, path)) WITHOUT ROWID""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS keywords_path ON keywords (path)")
+        self.connection.commit()
+
+    @staticmethod
+    def index_terms(keywords):
+        terms = set()
+        for keyword in keywords:
+            keyword = keyword.lower()
+            terms.add(keyword)
+            terms.update(part for part in keyword.split("-") if part)
+        return terms
+
+    def record(self, path, source, content_hash, model, keywords):
+        with self.lock:
+            self.connection.execute("DELETE FROM keywords WHERE path=?", (path,))
+            self.connection.execute("""INSERT OR REPLACE INTO files
+                (path, source, hash, model, keywords, updated) VALUES (?, ?, ?, ?, ?, ?)""",
+                (path, source, content_hash, model, json.dumps(keywords), time.time()))
+            self.connection.executemany("INSERT OR IGNORE INTO keywords (keyword, path) VALUES (?, ?)",
+                                        [(term, path) for term in self.index_terms(keywords)])
+            self.connection.commit()
+
+    def remove(self, path):
+        with self.lock:
+            self.connection.execute("DELETE FROM keywords WHERE path=?", (path,))
+            self.connection.execute("DELETE FROM files WHERE path=?", (path,))
+            self.connection.commit()
+
+    def search(self, terms, match_all=True, limit=0):
+        """
+        Finds the files indexed under the search terms.
+
+        Args:
+            terms (list[str]): Keywords to look up, case insensitive. A trailing * matches keywords starting with the term.
+            match_all (bool): Files need every term, otherwise any of them.
+            limit (int): Most files returned, 0 for no limit.
+
+        Returns:
+            list[dict]: The path, source, hash, model, keywords and updated time of each file, sorted by path.
+        """
+        queries = []
+        parameters = []
+        for term in terms:
+            term = term.lower()
+            if term.endswith("*"):
+                # Prefix match as a range, so the keyword index is used
+                queries.append("SELECT path FROM keywords WHERE keyword >= ? AND keyword < ?")
+                parameters += [term[:-1], term[:-1] + "\uffff"]
+            else:
+                queries.append("SELECT path FROM keywords WHERE keyword = ?")
+                parameters.append(term)
+        if not queries:
+            return []
+        query = f"""SELECT path, source, hash, model, keywords, updated FROM files WHERE path IN
+            ({(" INTERSECT " if match_all else " UNION ").join(queries)}) ORDER BY path"""
+        if limit > 0:
+            query += f" LIMIT {int(limit)}"
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        return [{"path": row[0], "source": row[1], "hash": row[2], "model": row[3],
+                 "keywords": json.loads(row[4]), "updated": row[5]} for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+def write_bytes(file_path, data):
+    with open(file_path, "wb") as file:
+        file.write(data)
+
+def create_temp_file(destination_file_path):
+    # An empty temp file next to the destination, renamed into place once written. Incremental runs
+    # remove the ones an interrupted run leaves behind
+    temp_fd, temp_file_path = tempfile.mkstemp(prefix=".", suffix=".part", dir=os.path.dirname(destination_file_path))
+    os.close(temp_fd)
+    # mkstemp makes the file private (0600), give it the permissions of a normally created file.
+    # Copies replace them with the source permissions
+    os.chmod(temp_file_path, 0o666 & ~UMASK)
+    return temp_file_path
+
+def atomic_save(destination_file_path, save):
+    # Call save with a temp file next to the destination then rename it into place,
+    # so a crash never leaves a half written file under the final name
+    temp_file_path = create_temp_file(destination_file_path)
+    try:
+        save(temp_file_path)
+        os.replace(temp_file_path, destination_file_path)
+    except BaseException:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+
+def clone_file(source_file_path, destination_file_path):
+    # Copy on write clone (reflink) with the Linux FICLONE ioctl, raises OSError where it isn't supported
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflinks are not supported on this platform")
+    with open(source_file_path, "rb") as source_file, open(destination_file_path, "wb") as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+def fast_copy(source_file_path, destination_file_path):
+    # Copy the content inside the kernel with copy_file_range (which file systems can turn into a
+    # clone or a server side copy) or sendfile, falling back to reads and writes with a large buffer
+    with open(source_file_path, "rb") as source_file, open(destination_file_path, "wb") as destination_file:
+        size = os.fstat(source_file.fileno()).st_size
+        for copy_range in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if copy_range is None:
+                continue
+            offset = 0
+            try:
+                while offset < size:
+                    count = min(COPY_BUFFER_SIZE, size - offset)
+                    if copy_range is os.sendfile:
+                        copied = os.sendfile(destination_file.fileno(), source_file.fileno(), offset, count)
+                    else:
+                        copied = os.copy_file_range(source_file.fileno(), destination_file.fileno(), count, offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+            except OSError:
+                pass
+            if offset >= size:
+                return
+            # Not supported between these files, start again with the next method
+            destination_file.seek(0)
+            destination_file.truncate()
+        shutil.copyfileobj(source_file, destination_file, COPY_BUFFER_SIZE)
+
+def transfer_file(source_file_path, destination_file_path):
+    """
+    Writes a copy of source_file_path to destination_file_path (which may already exist as an
+    empty temp file) using TRANSFER_MODE, keeping file times and permissions like shutil.copy2.
+    "hardlink" and "reflink" need source and destination on the same file system and fall back
+    to copying otherwise, "auto" tries a reflink when they share a file system.
+    """
+    source_device = os.stat(source_file_path).st_dev
+    destination_device = os.stat(os.path.dirname(destination_file_path) or ".").st_dev
+    same_file_system = source_device == destination_device
+    if TRANSFER_MODE == "hardlink" and same_file_system:
+        try:
+            if os.path.exists(destination_file_path):
+                os.remove(destination_file_path)
+            os.link(source_file_path, destination_file_path)
+            return
+        except OSError as e:
+            print(f"Hardlink of '{source_file_path}' failed ({e}), copying instead")
+    if TRANSFER_MODE in ("reflink", "auto") and same_file_system and source_device not in reflink_unsupported:
+        try:
+            clone_file(source_file_path, destination_file_path)
+            shutil.copystat(source_file_path, destination_file_path)
+            return
+        except OSError as e:
+            # Remember file systems without reflinks so they are not tried for every file
+            reflink_unsupported.add(source_device)
+            if TRANSFER_MODE == "reflink":
+                print(f"Reflink of '{source_file_path}' failed ({e}), copying instead")
+    fast_copy(source_file_path, destination_file_path)
+    shutil.copystat(source_file_path, destination_file_path)
+
+def process_file(source_file_path, destination_folder_path, heic_files):
+    """
+    Copies (or converts) a single file into its destination folder. Still images are captioned
+    first so they are written once, straight to a name built from the LLM keywords.
+
+    Args:
+        source_file_path (str): The path of the file to process.
+        destination_folder_path (str): The folder the processed file is written to.
+        heic_files (set[str]): Names (without extension) of the heic files in the source folder.
+
+    Returns:
+        tuple[str, list[str], str, str]: The final destination path (None if nothing was written),
+        the keywords, the content hash of still images and a status of "done", "skipped" or "failed".
+    """
+    file_name = os.path.basename(source_file_path)
+    destination_file_path = os.path.join(destination_folder_path, file_name)
+    fileroot, extension = os.path.splitext(source_file_path)
+    debug_print(f"extension:'{extension}'")
+    handler = FORMAT_HANDLERS.get(extension.lower())
+    if handler is None:
+        return None, [], None, "skipped"
+    # In memory image for the LLM, set when the file was already decoded here
+    image_data=None
+    # Converted file already written to a temp file, renamed to its final name once captioned
+    converted_temp_path=None
+    try:
+        if handler.action == "convert" and HEIC_OUTPUT != "keep":
+            # For heic files
+            # Use pillow_heif to make a HEIC_OUTPUT version of the heif file in memory,
+            # keeping a downsized copy in memory for the LLM
+            destination_file_path = os.path.splitext(destination_file_path)[0] + OUTPUT_ENCODERS[HEIC_OUTPUT]["extension"]
+            with decode_slots, memory_reserved(source_file_path, output_copy=True):
+                converted = convert_image(source_file_path, HEIC_OUTPUT)
+                if converted is None:
+                    return None, [], None, "failed"
+                converted_bytes, image_data = converted
+                # Written out while the memory is still reserved, so the full size file isn't held
+                # (outside the budget) while the image is captioned. Still written only once
+                with run_stats.timed("copy"):
+                    converted_temp_path = create_temp_file(destination_file_path)
+                    write_bytes(converted_temp_path, converted_bytes)
+                del converted, converted_bytes
+        elif handler.action == "live_photo" and os.path.basename(fileroot) in heic_files:
+            # Only copy mov files if not sourced from a heic file snapshot
+            return None, [], None, "skipped"
+        else:
+            # All other supported files, just copy
+            write_file = lambda temp_file_path: transfer_file(source_file_path, temp_file_path)
+        keywords=[]
+        content_hash=None
+        status="done"
+        if handler.caption:
+            # Still image files, caption them first so the file is written once, under its final name
+            with run_stats.timed("hash"):
+                content_hash = file_hash(source_file_path)
+            keywords=getImageKeywords(source_file_path, content_hash, image_data)
+            if keywords:
+                destination_file_path=keywords_to_filename(destination_file_path,keywords)
+            else:
+                # Written under its original name, incremental runs will retry it
+                status="failed"
+        with run_stats.timed("copy"):
+            if converted_temp_path is not None:
+                os.replace(converted_temp_path, destination_file_path)
+                converted_temp_path = None
+            else:
+                atomic_save(destination_file_path, write_file)
+        print(f"Copied: '{source_file_path}' to '{destination_file_path}'")
+        return destination_file_path, keywords, content_hash, status
+    except IOError as e:
+        print(f"Error copying '{source_file_path}': {e}")
+        return None, [], None, "failed"
+    except Exception as e:
+        print(f"An unexpected error occurred while copying '{source_file_path}': {e}")
+        return None, [], None, "failed"
+    finally:
+        if converted_temp_path is not None and os.path.exists(converted_temp_path):
+            os.remove(converted_temp_path)
+
+def walk_tree(folder, skip=None, report_errors=True):
+    """
+    Walks a folder tree one directory at a time using os.scandir, top down with
+    subfolders in sorted order. Symlinked folders are not followed.
+
+    Args:
+        folder (str): The folder to walk.
+        skip (callable): Called with each directory path before it is read, True leaves it
+            and its subfolders out.
+        report_errors (bool): Print the directories that can't be read, they are skipped either way.
+
+    Yields:
+        tuple[str, list[os.DirEntry]]: The directory path and the entries of the files in it.
+    """
+    pending=[folder]
+    while pending:
+        directory_path = pending.pop()
+        if skip is not None and skip(directory_path):
+            continue
+        file_entries=[]
+        subdirectories=[]
+        try:
+            with os.scandir(directory_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.is_file():
+                        file_entries.append(entry)
+        except OSError as e:
+            if report_errors:
+                print(f"Error scanning '{directory_path}': {e}")
+            continue
+        yield directory_path, file_entries
+        # Reverse sorted on the stack so subdirectories come off in sorted order
+        pending.extend(sorted(subdirectories, reverse=True))
+
+def heic_names(file_names):
+    # Names (without extension) of the heic files among file_names, used to pair live photo mov files
+    heic_files=set()
+    for file_name in file_names:
+        fileroot, extension = os.path.splitext(file_name)
+        handler = FORMAT_HANDLERS.get(extension.lower())
+        if handler is not None and handler.action == "convert":
+            heic_files.add(fileroot)
+    return heic_files
+
+def scan_source(source_folder):
+    """
+    Streams the source tree one directory at a time with walk_tree, with the entries
+    in sorted order, so work can start as soon as the first directory is read.
+
+    Args:
+        source_folder (str): The path to the source folder.
+
+    Yields:
+        tuple[str, list[str], set[str]]: The directory path, the sorted file names in it and the
+        names (without extension) of its heic files, used to pair live photo mov files.
+    """
+    scan_start = time.perf_counter()
+    for directory_path, file_entries in walk_tree(source_folder):
+        file_names = sorted(entry.name for entry in file_entries)
+        heic_files = heic_names(file_names)
+        run_stats.record("scan", time.perf_counter() - scan_start)
+        yield directory_path, file_names, heic_files
+        scan_start = time.perf_counter()
+
+def count_files(source_folder, progress):
+    # Counts the files under source_folder into progress["counted"], setting progress["total"] when done.
+    # Run on a background thread so the count never delays the start of the work
+    for _, file_entries in walk_tree(source_folder, report_errors=False):
+        progress["counted"]+=len(file_entries)
+    progress["total"]=progress["counted"]
+
+def process_files(source_folder, destination_folder, workers=1, incremental=False, index=True, directories=None):
     """
     Iterates through files in a named folder and its subfolders,
     and copies them to a new destination folder.
 
+    With more than one worker the files are handed to a thread pool so HEIC decoding,
+    copying and LLM captioning of different files overlap. At most workers*2 files are
+    queued at any time so memory stays bounded on very large trees.
+
+    In incremental mode existing destination folders are allowed and a manifest in the
+    destination folder records every processed file. Files already done and unchanged
+    since are skipped, failed, new and changed files are (re)processed.
+
     Args:
         source_folder (str): The path to the source folder.
         destination_folder (str): The path to the destination folder.
+        workers (int): Number of files processed concurrently.
+        incremental (bool): Resume into an existing destination using the manifest.
+        index (bool): Record the keywords of captioned files in a KeywordIndex in the destination folder.
+        directories (list[tuple[str, list[str], set[str]]]): Directories to process as (path, file names,
+            heic file names), as from scan_source. Defaults to scanning source_folder.
     """
     if not os.path.exists(source_folder):
         print(f"Error: Source folder '{source_folder}' does not exist.")
         return
 
-    # Create the destination folder if it doesn't exist
-    files_count_total=0
-    for root, _, files in os.walk(source_folder):
-        # Walks through folder (root) contained in the source directory
-        for file_name in files:
-            files_count_total+=1
+    # Count the files in the background for the progress display
+    files_count={"counted": 0, "total": None}
+    if directories is None:
+        threading.Thread(target=count_files, args=(source_folder, files_count), daemon=True).start()
+    else:
+        files_count["total"] = sum(len(files) for _, files, _ in directories)
+
+    manifest=None
+    if incremental:
+        os.makedirs(destination_folder, exist_ok=True)
+        manifest = RunManifest(os.path.join(destination_folder, MANIFEST_FILE_NAME))
+    # Opened once the destination folder exists, a normal run fails if it already does
+    keyword_index=None
 
+    run_stats.start()
     file_count=0
-    for root, _, files in os.walk(source_folder):
-        # Walks through folder (root) contained in the source directory
+    skipped_count=0
+    count_lock = threading.Lock()
+    queue_slots = threading.BoundedSemaphore(max(1, workers) * 2)
+
+    def run_file(source_file_path, destination_folder_path, heic_files):
+        nonlocal file_count, skipped_count
+        status = "failed"
+        relative_source = os.path.relpath(source_file_path, source_folder)
+        file_stat = None
+        try:
+            with count_lock:
+                file_count+=1
+                files_count_total = files_count["total"] if files_count["total"] is not None else f"{files_count['counted']}+"
+                print(f"\nFile: {file_count} / {files_count_total}    {round(run_stats.elapsed(),1)}")
+            run_stats.begin_file(source_file_path)
+            if manifest is None:
+                final_path, keywords, content_hash, status = process_file(source_file_path, destination_folder_path, heic_files)
+                if keyword_index is not None and status == "done" and keywords:
+                    keyword_index.record(os.path.relpath(final_path, destination_folder), os.path.abspath(source_file_path),
+                                         content_hash, caption_engine_settings["model"], keywords)
+                return
+            file_stat = os.stat(source_file_path)
+            entry = manifest.lookup(relative_source)
+            if is_unchanged(entry, file_stat, destination_folder):
+                print(f"Skipped unchanged '{source_file_path}'")
+                status = "unchanged"
+                with count_lock:
+                    skipped_count+=1
+                return
+            if entry is not None and entry["destination"]:
+                # Changed or failed earlier, remove the old output before writing the new one
+                old_destination = os.path.join(destination_folder, entry["destination"])
+                if os.path.exists(old_destination):
+                    os.remove(old_destination)
+                if keyword_index is not None:
+                    keyword_index.remove(entry["destination"])
+            final_path, keywords, content_hash, status = process_file(source_file_path, destination_folder_path, heic_files)
+            if final_path is not None:
+                final_path = os.path.relpath(final_path, destination_folder)
+            if keyword_index is not None and status == "done" and keywords:
+                keyword_index.record(final_path, os.path.abspath(source_file_path), content_hash,
+                                     caption_engine_settings["model"], keywords)
+            manifest.record(relative_source, file_stat.st_size, file_stat.st_mtime, content_hash, final_path, keywords, status)
+        except Exception as e:
+            # Report and record the file as failed, so one bad file neither stops the run nor gets lost in a worker
+            status = "failed"
+            print(f"An unexpected error occurred while processing '{source_file_path}': {e!r}")
+            if manifest is not None:
+                try:
+                    # An unknown size never matches, so the next incremental run retries the file
+                    manifest.record(relative_source, file_stat.st_size if file_stat else -1,
+                                    file_stat.st_mtime if file_stat else -1, None, None, [], status)
+                except Exception as e:
+                    print(f"Error recording '{source_file_path}' in the manifest: {e!r}")
+        finally:
+            run_stats.end_file(status)
+            queue_slots.release()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for root, files, heic_files in (scan_source(source_folder) if directories is None else directories):
+            # Walks through folder (root) contained in the source directory
+            relative_path = os.path.relpath(root, source_folder)
+            destination_folder_path =os.path.join(destination_folder, relative_path)
+            debug_print(f"walker root:'{root}' relative_path:'{relative_path}' destination_folder_path:'{destination_folder_path}'")
+            if incremental:
+                os.makedirs(destination_folder_path, exist_ok=True)
+                # Remove temp files left behind by an interrupted run
+                for leftover in os.listdir(destination_folder_path):
+                    if leftover.startswith(".") and leftover.endswith(".part"):
+                        os.remove(os.path.join(destination_folder_path, leftover))
+            # First make sure the destination folder doesn't already exist 
+            elif  os.path.exists(destination_folder_path):
+                print(f"Error: Destination folder '{destination_folder_path}' already exists.")
+                return
+            else:
+                    os.makedirs(destination_folder_path, exist_ok=False)
+            if index and keyword_index is None:
+                keyword_index = KeywordIndex(os.path.join(destination_folder, KEYWORD_INDEX_FILE_NAME))
+            # heic_files is used to decide which MOV files not to copy,
+            #  I don't want to copy the ones that match heic file names 
+            debug_print(heic_files)
+            # Files come from the scanner in sorted order so output is the same from run to run
+            for file_name in files:
+                source_file_path = os.path.join(root, file_name)
+                # Blocks once the queue is full until a worker finishes a file
+                queue_slots.acquire()
+                if workers <= 1:
+                    run_file(source_file_path, destination_folder_path, heic_files)
+                else:
+                    executor.submit(run_file, source_file_path, destination_folder_path, heic_files)
+    run_stats.end_time = time.time()
+    if manifest is not None:
+        print(f"Skipped {skipped_count} unchanged files")
+        manifest.close()
+    if keyword_index is not None:
+        keyword_index.close()
+
+# Per file seconds of each stage used by --plan estimates without a --plan-stats report,
+# rough figures for 12MP photos and a vision model on one GPU
+DEFAULT_STAGE_SECONDS={"hash": 0.02, "cache": 0.001, "heic_decode": 0.5, "preprocess": 0.1, "llm": 5.0, "copy": 0.05}
+# Stages each planned action goes through, heic files add heic_decode
+PLAN_ACTION_STAGES={
+    "caption": ["hash", "cache", "preprocess", "dedupe", "llm", "copy"],
+    "cached": ["hash", "cache", "copy"],
+    "copy": ["copy"],
+}
+# Stages that scale with the file size, estimated per byte when the report has file sizes
+BYTE_RATE_STAGES={"hash", "copy"}
+
+def plan_files(source_folder, destination_folder, incremental=False):
+    """
+    Scans the source tree and classifies every file without writing anything, for --plan.
+    Still images are hashed to look them up in the caption cache when there is one.
+
+    Args:
+        source_folder (str): The path to the source folder.
+        destination_folder (str): The path to the destination folder.
+        incremental (bool): The run resumes into an existing destination using its manifest.
+
+    Returns:
+        dict: The plan, with the source and destination, settings, per directory file lists
+        (name, size, mtime and action of caption, convert, cached, copy, skip_live_photo,
+        unchanged or unsupported) and the conflicts found.
+    """
+    manifest=None
+    manifest_path = os.path.join(destination_folder, MANIFEST_FILE_NAME)
+    if incremental and os.path.exists(manifest_path):
+        manifest = RunManifest(manifest_path)
+    plan = {"source": source_folder, "destination": destination_folder, "created": time.time(),
+            "heic_output": HEIC_OUTPUT, "incremental": incremental, "directories": [], "conflicts": []}
+    for root, files, heic_files in scan_source(source_folder):
         relative_path = os.path.relpath(root, source_folder)
-        destination_folder_path =os.path.join(destination_folder, relative_path)
-        debug_print(f"walker root:'{root}' relative_path:'{relative_path}' destination_folder_path:'{destination_folder_path}'")
-        # First make sure the destination folder doesn't already exist 
-        if  os.path.exists(destination_folder_path):
-            print(f"Error: Destination folder '{destination_folder_path}' already exists.")
-            return
-        else:
-                os.makedirs(destination_folder_path, exist_ok=False)
-        # Get a list of heic files in the folder, use this to decide which MOV files not to copy
-        #  I don't want to copy the ones that match heic file names 
-        heic_files=[]
-        for file_name in files:
-            fileroot, extension = os.path.splitext(file_name)
-            if extension.lower()==".heic":
-                heic_files.append(os.path.basename(fileroot))
-        debug_print(heic_files)
+        destination_folder_path = os.path.normpath(os.path.join(destination_folder, relative_path))
+        if not incremental and os.path.exists(destination_folder_path):
+            plan["conflicts"].append(f"Destination folder '{destination_folder_path}' already exists")
+        planned_files=[]
+        # Output names before the keywords are added, lower case as file systems may ignore case
+        output_names={}
         for file_name in files:
-            file_count+=1
-            print("\nFile:",file_count,"/" , files_count_total, "  ",round(time.time() - start_time,1))
             source_file_path = os.path.join(root, file_name)
-            destination_file_path = os.path.join(destination_folder_path, file_name)
+            file_stat = os.stat(source_file_path)
+            fileroot, extension = os.path.splitext(file_name)
+            handler = FORMAT_HANDLERS.get(extension.lower())
+            output_name = file_name
+            if handler is None:
+                action = "unsupported"
+            elif handler.action == "live_photo" and fileroot in heic_files:
+                action = "skip_live_photo"
+            else:
+                action = "convert" if handler.action == "convert" and HEIC_OUTPUT != "keep" else "copy"
+                if action == "convert":
+                    output_name = fileroot + OUTPUT_ENCODERS[HEIC_OUTPUT]["extension"]
+                if manifest is not None:
+                    entry = manifest.lookup(os.path.relpath(source_file_path, source_folder))
+                    if is_unchanged(entry, file_stat, destination_folder):
+                        action = "unchanged"
+                if action != "unchanged" and handler.caption:
+                    action = "caption" if action == "copy" else action
+                    if caption_cache is not None and caption_cache.contains(CaptionCache.make_key(
+                            file_hash(source_file_path), caption_engine_settings["model"], KEYWORD_PROMPT)):
+                        action = "cached"
+                if output_name.lower() in output_names:
+                    # Captioned files only differ by their keywords, near duplicates would overwrite each other
+                    plan["conflicts"].append(f"'{source_file_path}' and '{output_names[output_name.lower()]}' "
+                                             f"are both written as '{os.path.join(destination_folder_path, output_name)}'")
+                output_names[output_name.lower()] = source_file_path
+            planned_files.append({"name": file_name, "size": file_stat.st_size, "mtime": file_stat.st_mtime,
+                                  "action": action})
+        plan["directories"].append({"path": relative_path, "heic_files": sorted(heic_files), "files": planned_files})
+    if manifest is not None:
+        manifest.close()
+    return plan
+
+def stage_rates(report_path=None):
+    """
+    Per file and per byte seconds of each stage, from the summary and per file records of a
+    --report json file of an earlier run, or DEFAULT_STAGE_SECONDS without one.
+
+    Returns:
+        tuple[dict, dict]: Seconds per file and seconds per byte, keyed by stage.
+    """
+    if report_path is None:
+        return dict(DEFAULT_STAGE_SECONDS), {}
+    with open(report_path) as report_file:
+        report = json.load(report_file)
+    per_file = {stage: values["total"] / values["count"] for stage, values in report["summary"]["stages"].items()
+                if values["count"]}
+    per_byte = {}
+    for stage in BYTE_RATE_STAGES:
+        stage_seconds = sum(record["stages"].get(stage, 0) for record in report["files"] if record.get("bytes"))
+        stage_bytes = sum(record["bytes"] for record in report["files"] if record.get("bytes") and stage in record["stages"])
+        if stage_bytes:
+            per_byte[stage] = stage_seconds / stage_bytes
+    return per_file, per_byte
+
+def estimate_plan(plan, per_file, per_byte, workers=1, llm_workers=1):
+    """
+    Sums files, bytes and estimated seconds per action of a plan.
+
+    Returns:
+        tuple[dict, float]: Per action {"files", "bytes", "seconds"} totals and the estimated
+        run time in seconds with the given worker counts.
+    """
+    totals = {}
+    llm_seconds = 0
+    for directory in plan["directories"]:
+        heic_files = set(directory["heic_files"])
+        for planned_file in directory["files"]:
+            action = planned_file["action"]
+            stages = list(PLAN_ACTION_STAGES.get("caption" if action == "convert" else action, []))
+            fileroot, extension = os.path.splitext(planned_file["name"])
+            if action in ("convert", "cached") and fileroot in heic_files and plan["heic_output"] != "keep":
+                stages.append("heic_decode")
+            seconds = 0
+            for stage in stages:
+                if stage in per_byte:
+                    seconds += per_byte[stage] * planned_file["size"]
+                else:
+                    seconds += per_file.get(stage, 0)
+            if "llm" in stages:
+                llm_seconds += per_file.get("llm", 0)
+            action_totals = totals.setdefault(action, {"files": 0, "bytes": 0, "seconds": 0})
+            action_totals["files"] += 1
+            action_totals["bytes"] += planned_file["size"]
+            action_totals["seconds"] += seconds
+    work_seconds = sum(action_totals["seconds"] for action_totals in totals.values())
+    # Workers overlap all stages, the LLM requests are further limited to llm_workers at a time
+    return totals, max(work_seconds / max(1, workers), llm_seconds / max(1, llm_workers))
+
+def print_plan(plan, totals, estimated_seconds, rates_source):
+    print(f"\nPlan for '{plan['source']}' -> '{plan['destination']}'")
+    print(f"{'action':<16}{'files':>8}{'MB':>10}{'work s':>10}")
+    for action, action_totals in sorted(totals.items()):
+        print(f"{action:<16}{action_totals['files']:>8}{action_totals['bytes'] / 1048576:>10.1f}"
+              f"{action_totals['seconds']:>10.1f}")
+    minutes, seconds = divmod(round(estimated_seconds), 60)
+    print(f"Estimated run time: {minutes // 60}h {minutes % 60}m {seconds}s (stage times from {rates_source})")
+    for conflict in plan["conflicts"]:
+        print(f"Conflict: {conflict}")
+    if not plan["conflicts"]:
+        print("No destination conflicts")
+
+def planned_directories(plan):
+    # The directories of a plan as process_files takes them, leaving out files it would skip anyway
+    directories=[]
+    for directory in plan["directories"]:
+        root = os.path.normpath(os.path.join(plan["source"], directory["path"]))
+        files=[]
+        for planned_file in directory["files"]:
+            if planned_file["action"] in ("unsupported", "skip_live_photo", "unchanged"):
+                continue
+            source_file_path = os.path.join(root, planned_file["name"])
             try:
-                fileroot, extension = os.path.splitext(source_file_path)
-                debug_print(f"extension:'{extension}'")
-                if extension.lower()==".heic":
-                    # For heic files
-                    # Use pillow_heif to make a jpg version of any heif file as temp.jpg
-                    convert_heic_to_jpeg(source_file_path,"temp.jpg")
-                    # new_file_Path = os.path.join(destination_folder_path, file_name)
-                    jpg_file_path=destination_file_path.replace(extension,".jpg")
-                    shutil.copy2("temp.jpg", jpg_file_path)
-                    print(f"Copied: temp.jpg to '{jpg_file_path}'")
-                    destination_file_path=jpg_file_path
-                elif extension.lower() in [".jpg", ".png",".mp4",".jpeg",".gif",".bmp",".tif",".tiff"]:
-                    # All other supported files other than mov, just copy
-                    shutil.copy2(source_file_path, destination_file_path)
-                    print(f"Copied: '{source_file_path}' to '{destination_file_path}'")
-                elif extension.lower() in [".mov"]: 
-                    # Only copy mov files if not sourced from a heic file snapshot
-                    mov_fileroot, mov_extension = os.path.splitext(destination_file_path)
-                    if not (os.path.basename(mov_fileroot) in heic_files):
-                        shutil.copy2(source_file_path, destination_file_path)
-                        print(f"Copied: '{source_file_path}' to '{destination_file_path}'")
-            except IOError as e:
-                print(f"Error copying '{source_file_path}': {e}")
-            except Exception as e:
-                print(f"An unexpected error occurred while copying '{source_file_path}': {e}")
-            if extension.lower() in [".jpg", ".png",".heic",".jpg", ".png",".jpeg",".gif",".bmp",".tif",".tiff"]:
-                # Still image files, try generating a better file name
-                keywords=getImageKeywords(destination_file_path)
-                new_file_name=keywords_to_filename(destination_file_path,keywords)
+                file_stat = os.stat(source_file_path)
+            except OSError:
+                print(f"Planned file '{source_file_path}' no longer exists")
+                continue
+            if file_stat.st_size != planned_file["size"] or file_stat.st_mtime != planned_file["mtime"]:
+                print(f"Planned file '{source_file_path}' changed since the plan was made")
+            files.append(planned_file["name"])
+        directories.append((root, files, set(directory["heic_files"])))
+    return directories
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY=0x2
+IN_CLOSE_WRITE=0x8
+IN_MOVED_TO=0x80
+IN_CREATE=0x100
+IN_Q_OVERFLOW=0x4000
+IN_ISDIR=0x40000000
+
+class InotifyWatcher:
+    """
+    Reports files written or moved into a folder tree using Linux inotify through ctypes,
+    adding watches for new subdirectories as they appear. Raises OSError where inotify
+    is not available so the caller can fall back to PollingWatcher.
+
+    Args:
+        folder (str): The folder to watch, with its subfolders.
+        ignore (callable): Called with each path, True leaves it out.
+    """
+    def __init__(self, folder, ignore):
+        import ctypes
+        import ctypes.util
+        import select
+        import struct
+        self.ctypes = ctypes
+        self.select = select
+        self.struct = struct
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            inotify_init1 = self.libc.inotify_init1
+        except (OSError, AttributeError, TypeError):
+            raise OSError("inotify is not available on this platform")
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.ignore = ignore
+        # O_CLOEXEC
+        self.fd = inotify_init1(0o2000000)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.add_tree(folder)
+
+    def add_tree(self, folder):
+        # Watch folder and its subfolders, returning the files already in them
+        return [entry.path for _, file_entries in walk_tree(folder, self.skip_directory) for entry in file_entries]
+
+    def skip_directory(self, directory_path):
+        # Adds the watch of a folder before it is read, so no file added meanwhile is missed.
+        # True for folders left out, ignored or not watchable
+        if self.ignore(directory_path):
+            return True
+        watch = self.libc.inotify_add_watch(self.fd, os.fsencode(directory_path),
+                                            IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if watch < 0:
+            print(f"Error watching '{directory_path}': {os.strerror(self.ctypes.get_errno())}")
+            return True
+        self.watches[watch] = directory_path
+        return False
+
+    def changes(self, timeout):
+        # Paths of files changed or added, waiting at most timeout seconds for the first event.
+        # None means events were lost and the whole tree should be scanned again
+        readable, _, _ = self.select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        paths=[]
+        offset = 0
+        while offset < len(data):
+            watch, mask, cookie, name_length = self.struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + name_length].rstrip(b"\0")
+            offset += 16 + name_length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if watch not in self.watches or not name:
+                continue
+            path = os.path.join(self.watches[watch], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files can land in a new folder before its watch is added, pick them up here
+                    paths.extend(self.add_tree(path))
+            else:
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Reports files written or moved into a folder tree by scanning it every interval seconds
+    and comparing sizes and modification times, for platforms without inotify.
+
+    Args:
+        folder (str): The folder to watch, with its subfolders.
+        ignore (callable): Called with each path, True leaves it out.
+        interval (float): Seconds between scans.
+    """
+    def __init__(self, folder, ignore, interval):
+        self.folder = folder
+        self.ignore = ignore
+        self.interval = interval
+        self.next_scan = time.time() + interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot={}
+        for _, file_entries in walk_tree(self.folder, self.ignore):
+            for entry in file_entries:
+                try:
+                    entry_stat = entry.stat()
+                except OSError:
+                    # Removed since the folder was read
+                    continue
+                snapshot[entry.path] = (entry_stat.st_size, entry_stat.st_mtime)
+        return snapshot
+
+    def changes(self, timeout):
+        wait = self.next_scan - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0, wait))
+        self.next_scan = time.time() + self.interval
+        snapshot = self.scan()
+        paths = [path for path, signature in snapshot.items() if self.snapshot.get(path) != signature]
+        self.snapshot = snapshot
+        return paths
+
+    def close(self):
+        pass
+
+def watch_folder(source_folder, destination_folder, workers=1, index=True, settle=2.0, poll_interval=0,
+                 stats_interval=60):
+    """
+    Keeps captioning files as they arrive in the source folder until interrupted with Ctrl+C.
+    Existing files are brought up to date first with an incremental run, after that only new
+    and changed files go through process_files, with the same manifest, keyword index and
+    (warm) LLM client. Files are only processed once their size and modification time have
+    not changed for settle seconds, so partially written uploads are not picked up.
+
+    Args:
+        source_folder (str): The path to the source folder.
+        destination_folder (str): The path to the destination folder.
+        workers (int): Number of files processed concurrently.
+        index (bool): Record the keywords of captioned files in a KeywordIndex in the destination folder.
+        settle (float): Seconds a file must stay unchanged before it is processed.
+        poll_interval (float): Seconds between scans of the source, 0 uses inotify where available
+            and scans every 5 seconds elsewhere.
+        stats_interval (float): Seconds between printed queue depth and latency counters, 0 for none.
+    """
+    source_root = os.path.abspath(source_folder)
+    destination_root = os.path.abspath(destination_folder)
+
+    def ignore(path):
+        # Hidden files (temp and sync files), unsupported types and a destination inside the source
+        absolute_path = os.path.abspath(path)
+        if absolute_path == destination_root or absolute_path.startswith(destination_root + os.sep):
+            return True
+        if absolute_path == source_root:
+            return False
+        name = os.path.basename(absolute_path)
+        if name.startswith("."):
+            return True
+        return os.path.isfile(absolute_path) and os.path.splitext(name)[1].lower() not in FORMAT_HANDLERS
+
+    # Warm up the LLM client before the first arrival
+    get_caption_engine()
+    # One summary and report for the whole session, process_files no longer resets the stats
+    run_stats.start()
+    run_stats.accumulate = True
+
+    # The watcher starts before the catch up run, so files arriving during it are seen
+    watcher=None
+    if poll_interval <= 0:
+        try:
+            watcher = InotifyWatcher(source_folder, ignore)
+            print(f"Watching '{source_folder}' with inotify")
+        except OSError as e:
+            print(f"{e}, polling instead")
+            poll_interval = 5
+    if watcher is None:
+        watcher = PollingWatcher(source_folder, ignore, poll_interval)
+        print(f"Watching '{source_folder}', scanning every {poll_interval}s")
+
+    # Files waiting to settle: path -> (size, mtime, unchanged since, first seen)
+    settling={}
+    ready=queue.Queue()
+    counters={"queued": 0, "processing": 0, "processed": 0, "failed": 0, "latencies": []}
+    counters_lock=threading.Lock()
+
+    def process_ready():
+        # Processes the settled files in batches, grouped by folder, until a None arrives
+        while True:
+            batch = [ready.get()]
+            while not ready.empty():
+                batch.append(ready.get())
+            stop = None in batch
+            batch = [item for item in batch if item is not None]
+            if batch:
+                with counters_lock:
+                    counters["queued"] -= len(batch)
+                    counters["processing"] = len(batch)
+                folders={}
+                for path, first_seen in batch:
+                    folders.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+                directories=[]
+                for folder, file_names in folders.items():
+                    # Heic names of the whole folder, a live photo mov can arrive after its heic file
+                    try:
+                        heic_files = heic_names(os.listdir(folder))
+                    except OSError as e:
+                        # Renamed or removed after its files settled, a rename shows up as new files
+                        print(f"Error reading '{folder}': {e}")
+                        continue
+                    directories.append((folder, sorted(file_names), heic_files))
+                files_before = len(run_stats.files)
+                try:
+                    # Errors of single files are caught and recorded in process_files
+                    process_files(source_folder, destination_folder, workers, True, index, directories)
+                except Exception as e:
+                    print(f"Error processing new files: {e!r}")
+                done = time.time()
+                with counters_lock:
+                    counters["processing"] = 0
+                    counters["processed"] += len(batch)
+                    counters["failed"] += sum(1 for record in run_stats.files[files_before:] if record["status"] == "failed")
+                    counters["latencies"].extend(done - first_seen for _, first_seen in batch)
+                    # Only recent latencies are reported
+                    del counters["latencies"][:-1000]
+            if stop:
+                return
+
+    def print_counters():
+        with counters_lock:
+            latencies = sorted(counters["latencies"])
+            line = (f"Watch: {len(settling)} settling, {counters['queued']} queued, {counters['processing']} processing, "
+                    f"{counters['processed']} processed ({counters['failed']} failed)")
+            if latencies:
+                line += (f", arrival to done p50 {RunStats.percentile(latencies, 0.5):.1f}s "
+                         f"p95 {RunStats.percentile(latencies, 0.95):.1f}s")
+        print(line)
+
+    def stop_on_terminate(signal_number, frame):
+        raise KeyboardInterrupt
+    # Stop the same way on a service manager's SIGTERM as on Ctrl+C
+    import signal
+    signal.signal(signal.SIGTERM, stop_on_terminate)
+
+    processor = threading.Thread(target=process_ready, daemon=True)
+    processor.start()
+    try:
+        # Inside the try so stopping during the catch up still closes the watcher and prints the counters
+        print(f"Bringing '{destination_folder}' up to date")
+        process_files(source_folder, destination_folder, workers, True, index)
+        next_stats = time.time() + stats_interval
+        while True:
+            changed = watcher.changes(min(1.0, settle / 2) if settling else 1.0)
+            now = time.time()
+            if changed is None:
+                print("Watch events were lost, rescanning the source")
+                changed = PollingWatcher(source_folder, ignore, 0).snapshot.keys()
+            for path in changed:
+                if not ignore(path) and path not in settling:
+                    settling[path] = (None, None, now, now)
+            for path, (size, mtime, unchanged_since, first_seen) in list(settling.items()):
+                try:
+                    file_stat = os.stat(path)
+                except OSError:
+                    # Removed or renamed before it settled
+                    del settling[path]
+                    continue
+                if (file_stat.st_size, file_stat.st_mtime) != (size, mtime):
+                    settling[path] = (file_stat.st_size, file_stat.st_mtime, now, first_seen)
+                elif now - unchanged_since >= settle:
+                    del settling[path]
+                    with counters_lock:
+                        counters["queued"] += 1
+                    ready.put((path, first_seen))
+            if stats_interval > 0 and now >= next_stats:
+                print_counters()
+                next_stats = now + stats_interval
+    except KeyboardInterrupt:
+        print("\nStopping, finishing the files already queued")
+    finally:
+        watcher.close()
+        ready.put(None)
+        processor.join()
+        run_stats.end_time = time.time()
+        print_counters()
+
+def encode_for_llm(img, image_path, original_size, prepare_start):
+    # Downsize an opened image to LLM_IMAGE_MAX_EDGE in place and encode it without metadata
+    from PIL import ImageOps
+    # Downsize before applying the orientation, so only the small image is copied. The
+    # exif orientation is applied as the exif data is not sent along
+    if LLM_IMAGE_MAX_EDGE > 0:
+        img.thumbnail((LLM_IMAGE_MAX_EDGE, LLM_IMAGE_MAX_EDGE))
+    small_image = ImageOps.exif_transpose(img)
+    if small_image.mode != "RGB":
+        small_image = small_image.convert("RGB")
+    buffer = io.BytesIO()
+    small_image.save(buffer, format=LLM_IMAGE_FORMAT, quality=LLM_IMAGE_QUALITY)
+    image_bytes = buffer.getvalue()
+    print(f"Prepared '{image_path}' for LLM: {original_size} -> {len(image_bytes)} bytes "
+          f"({original_size - len(image_bytes)} saved) in {round(time.time() - prepare_start,3)}s")
+    return image_bytes, f"image/{LLM_IMAGE_FORMAT}"
+
+def prepare_image(image_path:str):
+    """
+    Downsizes an image to LLM_IMAGE_MAX_EDGE and re-encodes it as a compact jpeg/webp without
+    metadata, ready to be sent to the LLM. The vision model resizes images itself so sending
+    the full resolution file only costs upload and decode time. Upright jpeg, png and webp
+    files already within LLM_IMAGE_MAX_EDGE are sent as is.
+
+    Args:
+        image_path (str): The path to the image file.
+
+    Returns:
+        tuple[bytes, str]: The encoded image and its MIME type.
+    """
+    prepare_start=time.time()
+    original_size=os.path.getsize(image_path)
+    _, extension = os.path.splitext(image_path)
+    handler = FORMAT_HANDLERS.get(extension.lower())
+    if LLM_IMAGE_MAX_EDGE <= 0 and (handler is None or handler.action != "convert"):
+        # Preprocessing disabled, send the file as is. Vision models can't decode heic files,
+        # kept ones are still transcoded below (at full size)
+        with open(image_path, "rb") as image_file:
+            return image_file.read(), handler.mime_type if handler is not None else "image/jpeg"
+    with pil_image().open(image_path) as img:
+        # Exif orientation 1 (or none), the file is shown upright without applying it
+        if (max(img.size) <= LLM_IMAGE_MAX_EDGE and img.format in LLM_ORIGINAL_FORMATS
+                and img.getexif().get(0x0112, 1) == 1):
+            with open(image_path, "rb") as image_file:
+                image_bytes = image_file.read()
+            print(f"Prepared '{image_path}' for LLM: {original_size} bytes sent as is "
+                  f"in {round(time.time() - prepare_start,3)}s")
+            return image_bytes, img.get_format_mimetype()
+        # For jpeg files let the decoder scale down by 1/2, 1/4 or 1/8 while decoding,
+        # much faster than decoding the full image and resizing it
+        if LLM_IMAGE_MAX_EDGE > 0:
+            img.draft("RGB", (LLM_IMAGE_MAX_EDGE, LLM_IMAGE_MAX_EDGE))
+        return encode_for_llm(img, image_path, original_size, prepare_start)
+
+def perceptual_hash(image_bytes):
+    # 64 bit difference hash (dHash): shrink to 9x8 grey pixels and set a bit where a pixel is
+    # brighter than its right neighbour, so resizing, recompression and small edits barely change it.
+    # Returns None for low detail images (flat colours, black frames, clear sky, blank pages), their
+    # hashes are all or almost all the same bit whatever the content, so they would all match
+    with pil_image().open(io.BytesIO(image_bytes)) as img:
+        img.draft("L", (64, 64))
+        small_image = img.convert("L").resize((9, 8), pil_image().Resampling.BOX)
+    pixels = small_image.tobytes()
+    image_hash = 0
+    for row in range(8):
+        for column in range(8):
+            image_hash = (image_hash << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    if max(pixels) - min(pixels) < LOW_DETAIL_SPREAD or not LOW_DETAIL_BITS <= image_hash.bit_count() <= 64 - LOW_DETAIL_BITS:
+        return None
+    return image_hash
+
+def image_message(prompt, images):
+    # Build a message with the prompt followed by each (bytes, MIME type) image as base64
+    from langchain_core.messages import HumanMessage
+    content=[{"type": "text", "text": prompt}]
+    for index, (image_bytes, mime_type) in enumerate(images):
+        if len(images) > 1:
+            content.append({"type": "text", "text": f"Image {index}:"})
+        encoded_image = base64.b64encode(image_bytes).decode("utf-8")
+        content.append({"type": "image_url", "image_url": f"data:{mime_type};base64,{encoded_image}"})
+    return HumanMessage(content=content)
+
+class OllamaEndpoint:
+    """
+    One Ollama host, with its own client and structured output runnables (built once and
+    keeping their connections open) and the statistics used to schedule requests to it.
+
+    Args:
+        url (str): Base URL of the Ollama host.
+        model (str): The vision model name.
+        connections (int): Size of the HTTP connection pool to the host.
+        keep_alive (str|int): How long the host keeps the model loaded after a request, None for its own setting.
+    """
+    def __init__(self, url, model, connections, keep_alive=None):
+        import httpx
+        from langchain_ollama import ChatOllama
+        self.url = url.rstrip("/")
+        llm = ChatOllama(
+            model=model,
+            base_url=self.url,
+            temperature=0.0,
+            keep_alive=keep_alive,
+            client_kwargs={"limits": httpx.Limits(max_connections=connections, max_keepalive_connections=connections)}
+            )
+        # Use the structured output option on the llm to force output to follow the pydantic data types
+        self.runnables = {kind: llm.with_structured_output(schema, method="json_schema")
+                          for kind, schema in get_keyword_schemas().items()}
+        self.in_flight = 0
+        self.latency = None  # Moving average of successful request times in seconds
+        self.consecutive_failures = 0
+        self.drained_until = 0
+        self.healthy = True
+        self.completed = 0
+        self.failed = 0
+
+    def expected_wait(self, default_latency):
+        # Time a new request would take if the requests in flight are served one after the other
+        return (self.in_flight + 1) * (self.latency if self.latency is not None else default_latency)
+
+class CaptionEngine:
+    """
+    Sends LLM requests with ainvoke from an asyncio event loop running on its own thread,
+    so the worker threads share pooled HTTP connections to the Ollama hosts. Each request
+    goes to the available host with the least expected wait (requests in flight times its
+    observed latency). Requests are capped at concurrency in flight, each has a timeout,
+    timeouts, connection errors and 5xx/429 answers are retried with exponential backoff,
+    and a host with breaker_threshold failures in a row (or an overloaded answer) is drained
+    for breaker_cooldown seconds. Hosts are health checked every health_interval seconds
+    and left out while they fail.
+
+    Args:
+        urls (list[str]): Base URLs of the Ollama hosts.
+        model (str): The vision model name.
+        concurrency (int): Maximum requests in flight over all hosts.
+        timeout (float): Seconds before a request is abandoned and retried.
+        retries (int): Retries after the first attempt.
+        backoff (float): Seconds before the first retry, doubled for each retry after.
+        breaker_threshold (int): Consecutive failures that drain a host.
+        breaker_cooldown (float): Seconds a host is drained for.
+        health_interval (float): Seconds between health checks of the hosts.
+        keep_alive (str|int): How long the hosts keep the model loaded after a request, None for their own setting.
+    """
+    def __init__(self, urls, model, concurrency, timeout, retries, backoff, breaker_threshold, breaker_cooldown,
+                 health_interval=15, keep_alive=None):
+        self.model = model
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.health_interval = health_interval
+        self.retried = 0
+        self.failed = 0
+        self.endpoints = [OllamaEndpoint(url, model, concurrency, keep_alive) for url in urls]
+        self.start_time = time.time()
+        self.loop = asyncio.new_event_loop()
+        self.slots = asyncio.Semaphore(concurrency)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        # Check the hosts before the first request so dead ones are never tried, then keep checking
+        asyncio.run_coroutine_threadsafe(self.check_health(), self.loop).result()
+        self.health_task = asyncio.run_coroutine_threadsafe(self.start_monitor(), self.loop).result()
+
+    def invoke(self, kind, messages):
+        # Called from worker threads, blocks until the request succeeds or runs out of retries.
+        # kind is "single" or "batch", the output schema of the request
+        return asyncio.run_coroutine_threadsafe(self.ainvoke(kind, messages), self.loop).result()
+
+    def invoke_many(self, kind, messages_list):
+        # Send several requests concurrently, returns a result or exception for each
+        async def gather():
+            return await asyncio.gather(*[self.ainvoke(kind, messages) for messages in messages_list],
+                                        return_exceptions=True)
+        return asyncio.run_coroutine_threadsafe(gather(), self.loop).result()
+
+    @staticmethod
+    def is_retryable(e):
+        import httpx
+        if isinstance(e, (asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError)):
+            return True
+        status_code = getattr(e, "status_code", None)
+        return status_code is not None and (status_code >= 500 or status_code == 429)
+
+    async def check_health(self):
+        import httpx
+        async with httpx.AsyncClient(timeout=5) as client:
+            for endpoint in self.endpoints:
+                try:
+                    response = await client.get(f"{endpoint.url}/api/version")
+                    healthy = response.status_code == 200
+                except httpx.HTTPError:
+                    healthy = False
+                if healthy != endpoint.healthy:
+                    print(f"Ollama host {endpoint.url} is {'back up' if healthy else 'not responding, draining it'}")
+                endpoint.healthy = healthy
+
+    async def monitor_health(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health()
+
+    async def start_monitor(self):
+        return asyncio.create_task(self.monitor_health())
+
+    async def stop_monitor(self):
+        self.health_task.cancel()
+        await asyncio.gather(self.health_task, return_exceptions=True)
+
+    async def choose_endpoint(self):
+        # The available host with the least expected wait, waits while every host is drained
+        while True:
+            now = self.loop.time()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+            if not candidates:
+                # Nothing passes the health check, keep trying them all rather than stalling the run
+                candidates = self.endpoints
+            available = [endpoint for endpoint in candidates if endpoint.drained_until <= now]
+            if available:
+                latencies = [endpoint.latency for endpoint in self.endpoints if endpoint.latency is not None]
+                default_latency = sum(latencies) / len(latencies) if latencies else 1
+                return min(available, key=lambda endpoint: endpoint.expected_wait(default_latency))
+            await asyncio.sleep(min(endpoint.drained_until for endpoint in candidates) - now)
+
+    async def ainvoke(self, kind, messages):
+        attempt = 0
+        while True:
+            async with self.slots:
+                endpoint = await self.choose_endpoint()
+                endpoint.in_flight += 1
+                request_start = self.loop.time()
+                try:
+                    response = await asyncio.wait_for(endpoint.runnables[kind].ainvoke(messages), self.timeout)
+                    elapsed = self.loop.time() - request_start
+                    endpoint.latency = elapsed if endpoint.latency is None else 0.8 * endpoint.latency + 0.2 * elapsed
+                    endpoint.consecutive_failures = 0
+                    endpoint.completed += 1
+                    return response
+                except Exception as e:
+                    error = e
+                finally:
+                    endpoint.in_flight -= 1
+            if not self.is_retryable(error):
+                raise error
+            endpoint.failed += 1
+            endpoint.consecutive_failures += 1
+            overloaded = getattr(error, "status_code", None) in (429, 503)
+            if overloaded or endpoint.consecutive_failures >= self.breaker_threshold:
+                if endpoint.drained_until <= self.loop.time():
+                    print(f"Ollama host {endpoint.url} failing ({error!r}), draining it for {self.breaker_cooldown}s")
+                endpoint.drained_until = self.loop.time() + self.breaker_cooldown
+            if attempt >= self.retries:
+                self.failed += 1
+                raise error
+            delay = self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+            print(f"LLM request to {endpoint.url} failed ({error!r}), retry {attempt + 1}/{self.retries} in {round(delay,1)}s")
+            self.retried += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 0.001)
+        print(f"LLM requests retried: {self.retried}, failed after retries: {self.failed}")
+        for endpoint in self.endpoints:
+            latency = round(endpoint.latency, 2) if endpoint.latency is not None else "-"
+            print(f"  {endpoint.url}: {endpoint.completed} ok, {endpoint.failed} failed, "
+                  f"{round(endpoint.completed / elapsed, 2)} requests/s, latency {latency}s")
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.stop_monitor(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+class CaptionBatcher:
+    """
+    Groups images submitted by concurrent workers into multi image LLM requests, to spread
+    the per request overhead over several images. A batch is sent once batch_size images
+    are waiting or max_wait seconds after its first image arrived. If the model's answer
+    does not map exactly one keyword list to each image index the batch is redone as
+    single image requests.
+
+    Args:
+        batch_size (int): Maximum images per request.
+        max_wait (float): Seconds to wait for a batch to fill.
+        llm_workers (int): Number of batches being sent at the same time.
+    """
+    def __init__(self, batch_size, max_wait, llm_workers):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.batches_sent = 0
+        self.fallbacks = 0
+        self.count_lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=llm_workers)
+        self.thread = threading.Thread(target=self.collect, daemon=True)
+        self.thread.start()
+
+    def submit(self, image_bytes, mime_type):
+        # Returns a Future with the keyword list for the image
+        future = Future()
+        self.pending.put((image_bytes, mime_type, future))
+        return future
+
+    def collect(self):
+        stopping = False
+        while not stopping:
+            item = self.pending.get()
+            if item is None:
+                break
+            batch=[item]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.batch_size:
                 try:
-                    # Rename the file
-                    os.rename(destination_file_path, new_file_name)
-                    print(f"File '{destination_file_path}' successfully renamed to '{new_file_name}'.")
-                except FileNotFoundError:
-                    print(f"Error: The file '{destination_file_path}' was not found.")
-                except OSError as e:
-                    print(f"Error renaming file: {e}")
-                
+                    item = self.pending.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.executor.submit(self.send, batch)
+
+    def send(self, batch):
+        images = [(image_bytes, mime_type) for image_bytes, mime_type, _ in batch]
+        try:
+            results = self.invoke_batch(images) if len(batch) > 1 else None
+            if results is None:
+                if len(batch) > 1:
+                    print(f"Batch of {len(batch)} images did not map back to the images, retrying one by one")
+                    with self.count_lock:
+                        self.fallbacks += 1
+                messages = [[image_message(KEYWORD_PROMPT, [image])] for image in images]
+                results = get_caption_engine().invoke_many("single", messages)
+                results = [result if isinstance(result, Exception) else result.keywords for result in results]
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, _, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
 
+    def invoke_batch(self, images):
+        # One request for all the images, None if the answer doesn't have exactly one entry per image
+        prompt = (f"There are {len(images)} images, numbered 0 to {len(images) - 1} in the order given. "
+                  "For each image get a list of the top 4 keywords that describe it. "
+                  "Return one entry per image with its index.")
+        try:
+            response = get_caption_engine().invoke("batch", [image_message(prompt, images)])
+        except Exception as e:
+            print(f"Error invoking LLM for a batch: {e}")
+            return None
+        with self.count_lock:
+            self.batches_sent += 1
+        results = {}
+        for image in response.images:
+            if image.index in results or not 0 <= image.index < len(images) or not image.keywords:
+                return None
+            results[image.index] = image.keywords
+        if len(results) != len(images):
+            return None
+        return [results[index] for index in range(len(images))]
 
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
 
+def get_caption_engine():
+    # The engine is created on the first request so runs without still images never load langchain
+    global caption_engine
+    with caption_engine_lock:
+        if caption_engine is None:
+            caption_engine = CaptionEngine(**caption_engine_settings)
+    return caption_engine
+
+def request_keywords(image_bytes, mime_type):
+    # Raw keyword list from the LLM, through the batcher when batching is on
+    if caption_batcher is not None:
+        return caption_batcher.submit(image_bytes, mime_type).result()
+    response = get_caption_engine().invoke("single", [image_message(KEYWORD_PROMPT, [(image_bytes, mime_type)])])
+    return response.keywords
 
 @traceable
-def getImageKeywords(image_path:str):
-    # Read and encode image
-    with open(image_path, "rb") as image_file:
-        encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
-    # Create message with base64 image
-    message = HumanMessage(
-        content=[
-            {"type": "text", "text": "Get a list of the top 4 keywords that describe the image. "},
-            {
-                "type": "image_url",
-                "image_url": f"data:image/jpeg;base64,{encoded_image}"
-            },
-        ]
-    )
-
-    # Use the structured output option on the llm to force output to follow the File_Keywords data type 
-    # specified earlier using pydantic 
-    structured_llm = llm.with_structured_output(File_Keywords, method="json_schema")
+def getImageKeywords(image_path:str, content_hash:str=None, image_data:tuple[bytes, str]=None):
+    """
+    Gets cleaned up keywords describing an image, from the caption cache when the same
+    image content was already captioned with this model and prompt, otherwise from the LLM.
+
+    Args:
+        image_path (str): The path to the image sent to the LLM (the source file).
+        content_hash (str): Hash of the original file used in the cache key. Defaults to the hash of image_path.
+        image_data (tuple[bytes, str]): Image already prepared for the LLM and its MIME type,
+            image_path is only read when this is not given.
+    """
+    cache_key=None
+    if caption_cache is not None:
+        try:
+            cache_key = CaptionCache.make_key(content_hash or file_hash(image_path), caption_engine_settings["model"], KEYWORD_PROMPT)
+            with run_stats.timed("cache"):
+                cached_keywords = caption_cache.get(cache_key)
+            if cached_keywords is not None:
+                print(f"Cache hit for '{image_path}'")
+                return cached_keywords
+        except Exception as e:
+            print(f"Error reading caption cache: {e}")
+    # Read, downsize and encode image
     try:
-        response = structured_llm.invoke([message])
-        # Remove duplicates from the list
-        unique_list = list(set(response.keywords))
+        if image_data is None:
+            with memory_reserved(image_path, LLM_IMAGE_MAX_EDGE), run_stats.timed("preprocess"):
+                image_data = prepare_image(image_path)
+        image_bytes, mime_type = image_data
     except Exception as e:
-        print(f"Error invoking LLM: {e}")
-        unique_list=[]
+        print(f"Error preparing '{image_path}' for LLM: {e}")
+        return []
+    image_hash=None
+    if near_duplicates is not None:
+        try:
+            with run_stats.timed("dedupe"):
+                image_hash = perceptual_hash(image_bytes)
+                match = near_duplicates.claim(image_hash) if image_hash is not None else None
+            if match is not None:
+                distance, matched_keywords, matched_path = match
+                with near_duplicates.lock:
+                    near_duplicates.saved += 1
+                print(f"Near duplicate of '{matched_path}' (distance {distance}), reusing its keywords for '{image_path}'")
+                # Not cached, the cache only holds LLM results for the image's own content
+                return matched_keywords
+        except Exception as e:
+            print(f"Error checking '{image_path}' for near duplicates: {e}")
+            image_hash=None
+    try:
+        # Remove duplicates from the list, keeping the model's order so names are repeatable
+        with run_stats.timed("llm"):
+            unique_list = list(dict.fromkeys(request_keywords(image_bytes, mime_type)))
+    except Exception as e:
+        print(f"Error invoking LLM: {e!r}")
+        if image_hash is not None:
+            near_duplicates.release(image_hash, [], image_path)
+        return []
     # Remove special characters from list
     clean_unique_list=[]
     for keyword in unique_list:
         # This pattern matches any character that is NOT a letter, number, or space
         clean_keyword = re.sub(r'[^a-zA-Z0-9\s]', '', keyword).replace(" ","-")
-        clean_unique_list.append(clean_keyword)
+        # Keywords made only of special characters would leave empty parts in the file name
+        if clean_keyword:
+            clean_unique_list.append(clean_keyword)
+    if image_hash is not None:
+        # Near duplicates waiting on this image reuse its keywords, or caption themselves if there are none
+        near_duplicates.release(image_hash, clean_unique_list, image_path)
+    # Only successful LLM calls with at least one keyword are cached so failed images are retried next run
+    if cache_key is not None and any(clean_unique_list):
+        try:
+            caption_cache.put(cache_key, clean_unique_list)
+        except Exception as e:
+            print(f"Error writing caption cache: {e}")
     return(clean_unique_list)
 
+# Parser of the search mode, python aiImageCaption.py --search <destination> <keyword> ...
+# An option rather than a subcommand word, so it can't be mistaken for a source folder name
+search_parser = argparse.ArgumentParser(
+                    prog='aiImageCaption --search',
+                    description="Find captioned files by keyword in the index of a destination folder")
+search_parser.add_argument("destination", type=dir_path, help="Destination directory of an earlier run")
+search_parser.add_argument("keywords", nargs='+', help="Keywords to look for, a trailing * matches keywords starting with it")
+search_parser.add_argument('--any', action='store_true', help='List files with any of the keywords. Defaults to files with all of them')
+search_parser.add_argument('-l', '--limit', default=0, type=int, help='Most files listed. Defaults to 0 (no limit)')
+search_parser.add_argument('--json', action='store_true', help='Print the results as json')
+
+def search_main(argv):
+    # Runs the search mode, returns the exit code
+    search_args = search_parser.parse_args(argv)
+    index_path = os.path.join(search_args.destination, KEYWORD_INDEX_FILE_NAME)
+    if not os.path.exists(index_path):
+        print(f"Error: No keyword index '{index_path}', run aiImageCaption into this destination first.")
+        return 1
+    keyword_index = KeywordIndex(index_path)
+    results = keyword_index.search(search_args.keywords, not search_args.any, search_args.limit)
+    keyword_index.close()
+    if search_args.json:
+        print(json.dumps(results, indent=1))
+        return 0
+    for result in results:
+        print(f"{os.path.join(search_args.destination, result['path'])}  [{', '.join(result['keywords'])}]")
+    print(f"{len(results)} files found")
+    return 0
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "--search":
+    sys.exit(search_main(sys.argv[2:]))
+
 if __name__ == "__main__":
     args = parser.parse_args()
+    if args.watch:
+        for option, value in (("--profile", args.profile), ("--execute-plan", args.execute_plan),
+                              ("--plan", args.plan), ("--plan-out", args.plan_out)):
+            if value:
+                parser.error(f"--watch can't be combined with {option}")
     source_directory = args.source
     destination_directory = args.destination
     print(source_directory,destination_directory)
-    # Set up the model, using the chatOllama provider package
-    llm = ChatOllama(
-        model=args.model,
-        base_url=args.url,
-        temperature=0.0
-        )
-
-    process_files(source_directory, destination_directory)
\ No newline at end of file
+    LLM_IMAGE_MAX_EDGE = args.max_edge
+    LLM_IMAGE_FORMAT = args.llm_image_format
+    LLM_IMAGE_QUALITY = args.llm_image_quality
+    TRANSFER_MODE = args.transfer
+    HEIC_OUTPUT = args.heic_output
+    OUTPUT_ENCODERS["jpeg"]["save"]["quality"] = args.jpeg_quality
+    OUTPUT_ENCODERS["webp"]["save"]["quality"] = args.webp_quality
+    OUTPUT_ENCODERS["png"]["save"].update(compress_level=args.png_compress_level, optimize=args.png_optimize)
+    workers = max(1, args.workers)
+    decode_slots = threading.BoundedSemaphore(max(1, args.decode_workers or workers))
+    # Set up the model on each Ollama host, using the chatOllama provider package
+    urls = [url for url_list in (args.url or ["http://192.168.1.117:11434"]) for url in url_list.split(",") if url]
+    caption_engine_settings = {"urls": urls, "model": args.model, "concurrency": max(1, args.llm_workers or workers),
+                               "timeout": args.llm_timeout, "retries": args.llm_retries, "backoff": args.retry_backoff,
+                               "breaker_threshold": args.breaker_threshold, "breaker_cooldown": args.breaker_cooldown,
+                               "health_interval": args.health_interval}
+    # Keep the model loaded between arrivals in watch mode, Ollama takes durations or seconds
+    keep_alive = args.keep_alive or ("30m" if args.watch else None)
+    if keep_alive is not None and keep_alive.lstrip("-").isdigit():
+        keep_alive = int(keep_alive)
+    caption_engine_settings["keep_alive"] = keep_alive
+
+    # A single worker or LLM worker never has two images to batch, it would only wait out --batch-wait
+    if args.batch_size > 1 and workers > 1 and caption_engine_settings["concurrency"] > 1:
+        caption_batcher = CaptionBatcher(args.batch_size, args.batch_wait, max(1, args.llm_workers or workers))
+    if args.max_memory > 0:
+        memory_budget = MemoryBudget(args.max_memory * 1048576)
+    if args.dedupe:
+        near_duplicates = NearDuplicateIndex(args.dedupe_threshold)
+    planning = args.plan or args.plan_out
+    if not args.no_cache and planning:
+        # --plan writes nothing, so the cache is only read when there already is one
+        if os.path.exists(args.cache):
+            caption_cache = CaptionCache(args.cache, refresh=args.refresh_cache, read_only=True)
+    elif not args.no_cache:
+        caption_cache = CaptionCache(args.cache, args.cache_max_entries, args.cache_max_age, args.refresh_cache)
+
+    if planning:
+        if args.plan_stats and not os.path.exists(args.plan_stats):
+            print(f"Error: Report '{args.plan_stats}' does not exist.")
+            sys.exit(1)
+        plan = plan_files(source_directory, destination_directory, args.incremental)
+        per_file, per_byte = stage_rates(args.plan_stats)
+        totals, estimated_seconds = estimate_plan(plan, per_file, per_byte, workers, caption_engine_settings["concurrency"])
+        plan["estimate"] = {"totals": totals, "seconds": estimated_seconds, "workers": workers,
+                            "llm_workers": caption_engine_settings["concurrency"]}
+        print_plan(plan, totals, estimated_seconds, args.plan_stats or "built in defaults")
+        if args.plan_out:
+            with open(args.plan_out, "w") as plan_file:
+                json.dump(plan, plan_file, indent=1)
+            print(f"Plan written to '{args.plan_out}'")
+        if caption_cache is not None:
+            caption_cache.close()
+        sys.exit(1 if plan["conflicts"] else 0)
+    directories=None
+    if args.execute_plan:
+        with open(args.execute_plan) as plan_file:
+            plan = json.load(plan_file)
+        if os.path.normpath(plan["source"]) != os.path.normpath(source_directory) \
+                or os.path.normpath(plan["destination"]) != os.path.normpath(destination_directory):
+            print(f"Error: The plan is for '{plan['source']}' -> '{plan['destination']}'.")
+            sys.exit(1)
+        if plan["heic_output"] != HEIC_OUTPUT or plan["incremental"] != args.incremental:
+            print(f"Warning: The plan was made with --heic-output {plan['heic_output']}"
+                  f"{' --incremental' if plan['incremental'] else ''}")
+        directories = planned_directories(plan)
+
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.runcall(process_files, source_directory, destination_directory, workers, args.incremental,
+                         not args.no_index, directories)
+        profiler.dump_stats(args.profile)
+        print(f"Profile written to '{args.profile}'")
+    elif args.watch:
+        watch_folder(source_directory, destination_directory, workers, not args.no_index, args.watch_settle,
+                     args.watch_poll, args.watch_stats)
+    else:
+        process_files(source_directory, destination_directory, workers, args.incremental, not args.no_index, directories)
+    run_stats.print_summary()
+    if args.report:
+        run_stats.write_report(args.report)
+    if args.tracemalloc:
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        print(f"Traced memory: peak {round(peak_memory / 1048576, 1)}MB")
+        for statistic in tracemalloc.take_snapshot().statistics("lineno")[:10]:
+            print(f"  {statistic}")
+    if caption_batcher is not None:
+        caption_batcher.close()
+        print(f"Batched requests: {caption_batcher.batches_sent}, fallbacks to single images: {caption_batcher.fallbacks}")
+    if memory_budget is not None:
+        print(f"Memory budget: peak estimate {round(memory_budget.peak / 1048576, 1)}MB of {args.max_memory}MB, "
+              f"{memory_budget.waits} decodes waited for room")
+    if near_duplicates is not None:
+        print(f"Near duplicates: {near_duplicates.saved} LLM calls saved, {near_duplicates.size} distinct images indexed")
+    if caption_engine is not None:
+        caption_engine.close()
+        caption_engine.report()
+    if caption_cache is not None:
+        print(f"Caption cache: {caption_cache.hits} hits, {caption_cache.misses} misses")
+        caption_cache.close()
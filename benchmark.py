@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+from pillow_heif import register_heif_opener
+
+from mockOllama import start_mock_server
+
+# Offline throughput benchmark for aiImageCaption.py. Generates a synthetic photo tree,
+# runs the captioning CLI against local stub Ollama servers and appends files/s, peak RSS
+# and per stage latencies to a results file so runs of different versions can be compared.
+
+register_heif_opener()
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RESULTS = os.path.join(SCRIPT_DIR, "benchmarks", "results.jsonl")
+
+# (width, height) of the generated images, picked at random per file
+IMAGE_SIZES = [(640, 480), (2016, 1512), (4032, 3024)]
+# Share of each generated file type, heic files also get a live photo mov half of the time
+FILE_MIX = [(".heic", 0.35), (".jpg", 0.3), (".png", 0.1), (".tif", 0.05), (".mp4", 0.1), (".mov", 0.1)]
+FOLDERS = [".", "sub01", "sub02", os.path.join("sub02", "2024")]
+
+def synthetic_image(size, rng):
+    # Gradient with a few shapes, so encoders have some real work without noise sized files
+    width, height = size
+    img = Image.linear_gradient("L").resize(size).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(10, max(11, width // 6))
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+    return img
+
+def generate_tree(tree_folder, file_count, seed=0, video_size=2 * 1024 * 1024):
+    """
+    Writes a synthetic source tree of still images, videos and live photo pairs.
+
+    Args:
+        tree_folder (str): Folder to create the tree in.
+        file_count (int): Number of files to generate (live photo movs come on top).
+        seed (int): Random seed, the same seed gives the same tree.
+        video_size (int): Bytes of random data in each generated video file.
+    """
+    rng = random.Random(seed)
+    extensions = [extension for extension, _ in FILE_MIX]
+    weights = [weight for _, weight in FILE_MIX]
+    for folder in FOLDERS:
+        os.makedirs(os.path.join(tree_folder, folder), exist_ok=True)
+    for index in range(file_count):
+        extension = rng.choices(extensions, weights)[0]
+        folder = os.path.join(tree_folder, rng.choice(FOLDERS))
+        file_path = os.path.join(folder, f"IMG_{index:05d}{extension}")
+        if extension in (".mp4", ".mov"):
+            with open(file_path, "wb") as video_file:
+                video_file.write(rng.randbytes(video_size))
+            continue
+        img = synthetic_image(rng.choice(IMAGE_SIZES), rng)
+        if extension == ".heic":
+            img.save(file_path, format="heif", quality=80)
+            if rng.random() < 0.5:
+                # Live photo video, skipped by aiImageCaption
+                with open(os.path.join(folder, f"IMG_{index:05d}.MOV"), "wb") as video_file:
+                    video_file.write(rng.randbytes(video_size // 4))
+        elif extension == ".jpg":
+            img.save(file_path, format="jpeg", quality=90)
+        elif extension == ".png":
+            img.save(file_path, format="png", compress_level=1)
+        else:
+            img.save(file_path, format="tiff")
+
+def peak_child_rss_mb():
+    # Peak resident set size of finished child processes, not available on Windows
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1048576 if sys.platform == "darwin" else 1024), 1)
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(tree_folder, work_folder, urls, extra_args):
+    # Runs aiImageCaption.py once, returns the wall time and the parsed run report
+    destination_folder = os.path.join(work_folder, "output")
+    report_path = os.path.join(work_folder, "report.json")
+    shutil.rmtree(destination_folder, ignore_errors=True)
+    command = [sys.executable, os.path.join(SCRIPT_DIR, "aiImageCaption.py"), tree_folder, destination_folder,
+               "-u", ",".join(urls), "--no-cache", "--report", report_path, *extra_args]
+    run_start = time.time()
+    completed = subprocess.run(command, cwd=work_folder, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall_time = time.time() - run_start
+    if completed.returncode != 0:
+        print(completed.stderr)
+        raise RuntimeError(f"aiImageCaption.py exited with {completed.returncode}")
+    with open(report_path) as report_file:
+        return wall_time, json.load(report_file)
+
+def measure_startup(work_folder, runs):
+    # Median seconds for aiImageCaption.py --help and for a run over an empty folder
+    empty_folder = os.path.join(work_folder, "empty")
+    os.makedirs(empty_folder, exist_ok=True)
+    script = os.path.join(SCRIPT_DIR, "aiImageCaption.py")
+    commands = {
+        "help": [sys.executable, script, "--help"],
+        "empty_run": [sys.executable, script, empty_folder, os.path.join(work_folder, "empty_output"), "--no-cache", "-i"],
+    }
+    timings = {}
+    for name, command in commands.items():
+        samples = []
+        for _ in range(runs):
+            run_start = time.perf_counter()
+            subprocess.run(command, cwd=work_folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            samples.append(time.perf_counter() - run_start)
+        timings[name] = round(statistics.median(samples), 3)
+    return timings
+
+def previous_result(results_path, name):
+    # The last stored result of the same scenario, None if there isn't one
+    if not os.path.exists(results_path):
+        return None
+    previous = None
+    with open(results_path) as results_file:
+        for line in results_file:
+            result = json.loads(line)
+            if result.get("name") == name:
+                previous = result
+    return previous
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='benchmark',
+                                     description="Benchmark aiImageCaption.py on a synthetic photo tree with stub Ollama servers")
+    parser.add_argument('-n', '--files', default=100, type=int, help='Files in the generated tree. Defaults to 100')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed of the generated tree. Defaults to 0')
+    parser.add_argument('--tree', default=None, type=str,
+                        help='Folder for the generated tree, reused if it already exists. Defaults to a temp folder')
+    parser.add_argument('--hosts', default=1, type=int, help='Number of stub Ollama servers. Defaults to 1')
+    parser.add_argument('--latency', default=0.3, type=float, help='Seconds per stub chat request. Defaults to 0.3')
+    parser.add_argument('--failure-rate', default=0.0, type=float, help='Fraction of stub chat requests failing. Defaults to 0')
+    parser.add_argument('--name', default="default", type=str, help='Scenario name results are compared under. Defaults to default')
+    parser.add_argument('--results', default=DEFAULT_RESULTS, type=str,
+                        help='File results are appended to. Defaults to benchmarks/results.jsonl')
+    parser.add_argument('--args', default="", type=str,
+                        help='Extra arguments for aiImageCaption.py, for example "-w 8 --batch-size 4"')
+    parser.add_argument('--startup', action='store_true',
+                        help='Only measure startup time of --help and of a run over an empty folder')
+    parser.add_argument('--startup-budget', default=0.5, type=float,
+                        help='Seconds each startup measurement should stay under, exits with 1 if not. Defaults to 0.5')
+    parser.add_argument('--startup-runs', default=5, type=int, help='Runs per startup measurement. Defaults to 5')
+    args = parser.parse_args()
+
+    work_folder = tempfile.mkdtemp(prefix="aiImageCaption_bench_")
+    if args.startup:
+        timings = measure_startup(work_folder, args.startup_runs)
+        shutil.rmtree(work_folder, ignore_errors=True)
+        over_budget = [name for name, seconds in timings.items() if seconds > args.startup_budget]
+        for name, seconds in timings.items():
+            print(f"{name:<10} {seconds}s  {'OVER' if name in over_budget else 'ok'} (budget {args.startup_budget}s)")
+        result = {"name": "startup", "time": time.strftime("%Y-%m-%d %H:%M:%S"), "revision": git_revision(),
+                  "budget": args.startup_budget, **timings}
+        previous = previous_result(args.results, "startup")
+        if previous is not None:
+            print(f"Compared to {previous['revision']} ({previous['time']}): "
+                  + ", ".join(f"{name} {previous.get(name)}s" for name in timings))
+        os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+        with open(args.results, "a") as results_file:
+            results_file.write(json.dumps(result) + "\n")
+        sys.exit(1 if over_budget else 0)
+    tree_folder = args.tree or os.path.join(work_folder, "source")
+    if not os.path.exists(tree_folder):
+        print(f"Generating {args.files} files in '{tree_folder}'")
+        generate_tree(tree_folder, args.files, args.seed)
+    servers = [start_mock_server(latency=args.latency, failure_rate=args.failure_rate) for _ in range(args.hosts)]
+    extra_args = args.args.split()
+    # Retries against the stub servers should not wait seconds
+    if "--retry-backoff" not in extra_args:
+        extra_args += ["--retry-backoff", "0.1"]
+
+    wall_time, report = run_benchmark(tree_folder, work_folder, [server.url for server in servers], extra_args)
+    summary = report["summary"]
+    result = {
+        "name": args.name,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "revision": git_revision(),
+        "files": summary["files"],
+        "wall_time": round(wall_time, 2),
+        "files_per_second": round(summary["files_per_second"], 3),
+        "peak_rss_mb": peak_child_rss_mb(),
+        "llm_requests": sum(server.requests for server in servers),
+        "llm_failures": sum(server.failures for server in servers),
+        "settings": {"files": args.files, "seed": args.seed, "hosts": args.hosts, "latency": args.latency,
+                     "failure_rate": args.failure_rate, "args": args.args},
+        "stages": {stage: {key: round(value, 4) for key, value in values.items()}
+                   for stage, values in summary["stages"].items()},
+    }
+
+    print(f"\n{result['files']} files in {result['wall_time']}s, {result['files_per_second']} files/s, "
+          f"peak RSS {result['peak_rss_mb']}MB, {result['llm_requests']} LLM requests ({result['llm_failures']} failed)")
+    for stage, values in result["stages"].items():
+        print(f"  {stage:<12} p50 {values['p50']:.3f}s  p95 {values['p95']:.3f}s  max {values['max']:.3f}s")
+    previous = previous_result(args.results, args.name)
+    if previous is not None and previous.get("files_per_second"):
+        change = (result["files_per_second"] / previous["files_per_second"] - 1) * 100
+        print(f"Compared to {previous['revision']} ({previous['time']}): {previous['files_per_second']} files/s, "
+              f"{change:+.1f}%")
+        if previous.get("settings") != result["settings"]:
+            print("  Note: the previous run used different settings")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    with open(args.results, "a") as results_file:
+        results_file.write(json.dumps(result) + "\n")
+    print(f"Result appended to '{args.results}'")
+    # A generated tree given with --tree lives outside the work folder and is kept
+    shutil.rmtree(work_folder, ignore_errors=True)
@@ -0,0 +1,120 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stub of the parts of the Ollama HTTP API used by aiImageCaption, for testing the
+# multi host scheduling and for benchmarks without a GPU box. Chat requests answer with
+# fixed keywords after a configurable delay and fail at a configurable rate.
+
+KEYWORDS = ["dog", "beach", "sunset", "tree", "car", "mountain", "river", "city"]
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    # Settings are class attributes, each server gets its own subclass from start_mock_server
+    latency = 0.0
+    failure_rate = 0.0
+    failure_status = 500
+
+    def send_json(self, status, body, content_type="application/json"):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.server.down:
+            self.send_json(503, json.dumps({"error": "mock host down"}))
+        elif self.path == "/api/version":
+            self.send_json(200, json.dumps({"version": "0.0.0-mock"}))
+        elif self.path == "/api/tags":
+            self.send_json(200, json.dumps({"models": []}))
+        else:
+            self.send_json(404, json.dumps({"error": "not found"}))
+
+    def do_POST(self):
+        if self.path != "/api/chat":
+            self.send_json(404, json.dumps({"error": "not found"}))
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests += 1
+        if self.server.down:
+            self.server.failures += 1
+            self.send_json(503, json.dumps({"error": "mock host down"}))
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self.server.failures += 1
+            self.send_json(self.failure_status, json.dumps({"error": "mock failure"}))
+            return
+        images = sum(len(message.get("images") or []) for message in request.get("messages", []))
+        self.server.images += images
+        # Answer in the shape of the requested json schema, per image entries for batches
+        properties = (request.get("format") or {}).get("properties", {})
+        if "images" in properties:
+            content = {"images": [{"index": index, "keywords": random.sample(KEYWORDS, 4)} for index in range(images)]}
+        else:
+            content = {"keywords": random.sample(KEYWORDS, 4)}
+        message = {
+            "model": request.get("model"),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "message": {"role": "assistant", "content": json.dumps(content)},
+            "done": True,
+            "done_reason": "stop",
+        }
+        if request.get("stream", True):
+            self.send_json(200, json.dumps(message) + "\n", "application/x-ndjson")
+        else:
+            self.send_json(200, json.dumps(message))
+
+    def log_message(self, format, *args):
+        pass
+
+def start_mock_server(port=0, latency=0.0, failure_rate=0.0, failure_status=500):
+    """
+    Starts a stub Ollama server on a background thread.
+
+    Args:
+        port (int): Port to listen on, 0 picks a free port.
+        latency (float): Seconds each chat request takes.
+        failure_rate (float): Fraction of chat requests answered with failure_status.
+        failure_status (int): HTTP status of failed requests.
+
+    Returns:
+        ThreadingHTTPServer: The running server, its base URL is in server.url. Request counts
+        are kept in server.requests, server.failures and server.images. Setting server.down
+        answers every request, health checks included, with 503 until it is cleared.
+    """
+    handler = type("Handler", (MockOllamaHandler,),
+                   {"latency": latency, "failure_rate": failure_rate, "failure_status": failure_status})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.requests = 0
+    server.failures = 0
+    server.images = 0
+    server.down = False
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='mockOllama',
+                                     description="Run stub Ollama servers answering chat requests with fixed keywords")
+    parser.add_argument('-p', '--port', default=11500, type=int, help='First port, servers use consecutive ports. Defaults to 11500')
+    parser.add_argument('-n', '--count', default=1, type=int, help='Number of servers. Defaults to 1')
+    parser.add_argument('--latency', default=0.5, type=float, help='Seconds per chat request. Defaults to 0.5')
+    parser.add_argument('--failure-rate', default=0.0, type=float, help='Fraction of chat requests failing. Defaults to 0')
+    parser.add_argument('--failure-status', default=500, type=int, help='HTTP status of failing requests. Defaults to 500')
+    args = parser.parse_args()
+    servers = [start_mock_server(args.port + index, args.latency, args.failure_rate, args.failure_status)
+               for index in range(args.count)]
+    print("Mock Ollama servers:", " ".join(server.url for server in servers))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,93 @@
+import argparse
+import sys
+import time
+
+import aiImageCaption
+from mockOllama import start_mock_server
+
+# Offline check of the multi host scheduling in aiImageCaption.CaptionEngine against a failing
+# and a healthy stub Ollama server: requests keep succeeding while the failing host is drained
+# by the circuit breaker, a host failing its health check gets no requests, and once it
+# recovers it takes its share of the work again. Exits with 1 when a check fails.
+
+failed_checks=[]
+def check(name, condition, detail=""):
+    print(f"{'ok    ' if condition else 'FAILED'} {name}{f' ({detail})' if detail else ''}")
+    if not condition:
+        failed_checks.append(name)
+
+def wait_until(condition, timeout):
+    # Polls condition until it holds or timeout seconds pass, returns its last value
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+def send(engine, count):
+    # count concurrent single image requests, returns the number that succeeded
+    message = aiImageCaption.image_message(aiImageCaption.KEYWORD_PROMPT, [(b"check", "image/jpeg")])
+    results = engine.invoke_many("single", [[message] for _ in range(count)])
+    return sum(1 for result in results if not isinstance(result, Exception))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='schedulerCheck',
+                                     description="Check the Ollama host scheduling against a failing and a healthy stub server")
+    parser.add_argument('-n', '--requests', default=20, type=int, help='Requests sent in each phase. Defaults to 20')
+    parser.add_argument('--latency', default=0.05, type=float, help='Seconds per chat request of the stub servers. Defaults to 0.05')
+    args = parser.parse_args()
+
+    failing_server = start_mock_server(latency=args.latency, failure_rate=1.0)
+    healthy_server = start_mock_server(latency=args.latency)
+    concurrency = 4
+    breaker_threshold = 2
+    health_interval = 0.2
+    engine = aiImageCaption.CaptionEngine([failing_server.url, healthy_server.url], "mock", concurrency, timeout=5,
+                                          retries=3, backoff=0.01, breaker_threshold=breaker_threshold,
+                                          breaker_cooldown=1.0, health_interval=health_interval)
+    failing, healthy = engine.endpoints
+    try:
+        # Both hosts pass the health check, the failing one answers every chat request with a 500
+        print("Failing host drained by the circuit breaker")
+        ok = send(engine, args.requests)
+        check("all requests succeed", ok == args.requests, f"{ok}/{args.requests}")
+        check("failing host has no ok requests", failing.completed == 0, f"{failing.completed} ok")
+        check("failing host failures counted", failing.failed == failing_server.failures >= breaker_threshold,
+              f"{failing.failed} counted, {failing_server.failures} answered")
+        check("failing host drained before most requests", failing_server.requests <= concurrency,
+              f"{failing_server.requests} of {args.requests} reached it")
+        check("healthy host served every request", (healthy.completed, healthy.failed) == (args.requests, 0),
+              f"{healthy.completed} ok, {healthy.failed} failed")
+
+        # Down for the health check too, it is left out even once its drain has run out
+        print("Host failing its health check left out")
+        failing_server.RequestHandlerClass.failure_rate = 0.0
+        failing_server.down = True
+        check("health check marks it down", wait_until(lambda: not failing.healthy, 5))
+        time.sleep(max(0, failing.drained_until - engine.loop.time()))
+        requests_before = failing_server.requests
+        ok = send(engine, args.requests)
+        check("all requests succeed", ok == args.requests, f"{ok}/{args.requests}")
+        check("no requests to the unhealthy host", failing_server.requests == requests_before,
+              f"{failing_server.requests - requests_before} sent")
+
+        # Back up, least wait routing sends it work as soon as the healthy host has requests in flight
+        print("Recovered host back in use")
+        failing_server.down = False
+        check("health check marks it up", wait_until(lambda: failing.healthy, 5))
+        failed_before = failing.failed
+        ok = send(engine, args.requests)
+        check("all requests succeed", ok == args.requests, f"{ok}/{args.requests}")
+        check("recovered host serves requests", failing.completed > 0 and failing.failed == failed_before,
+              f"{failing.completed} ok, {failing.failed - failed_before} failed")
+        check("requests are shared", 0 < failing.completed < args.requests,
+              f"{failing.completed} recovered, {args.requests - failing.completed} healthy")
+        check("ok counts match the servers", failing.completed + healthy.completed == 3 * args.requests
+              and healthy.completed == healthy_server.requests - healthy_server.failures,
+              f"{failing.completed} + {healthy.completed}")
+        engine.report()
+    finally:
+        engine.close()
+        failing_server.shutdown()
+        healthy_server.shutdown()
+    print(f"{len(failed_checks)} checks failed" if failed_checks else "All checks passed")
+    sys.exit(1 if failed_checks else 0)